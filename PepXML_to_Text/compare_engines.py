@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+#
+# Parses .pepXML files with each available pepxml.py engine, confirms that every engine
+# returns the same PSMs as the xml.sax engine, and reports the parse time of each engine
+#
+
+import sys
+import time
+
+# Import pepxml.py, which should be in the same directory as compare_engines.py
+import pepxml
+
+usage_mesg = 'Usage: compare_engines.py FileToProcess.pepXML [FileToProcess2.pepXML ...]'
+
+if( len(sys.argv) < 2 ):
+    print(usage_mesg)
+    sys.exit(1)
+
+engines = [engine for engine in pepxml.ENGINES if engine != 'lxml' or pepxml.etree is not None]
+
+mismatch_count = 0
+for filename_pepxml in sys.argv[1:]:
+    print('Reading %s' % filename_pepxml)
+
+    results = dict()
+    seconds = dict()
+    for engine in ['sax'] + [engine for engine in engines if engine != 'sax']:
+        start_time = time.perf_counter()
+        results[engine] = pepxml.parse_by_filename(filename_pepxml, engine=engine)
+        seconds[engine] = time.perf_counter() - start_time
+
+    for engine in results.keys():
+        if( results[engine] == results['sax'] ):
+            status = 'identical'
+        else:
+            status = 'DIFFERENT'
+            mismatch_count += 1
+
+        print('  %-12s %8.3f sec  %5.2fx  %i spectra  %s' % (engine, seconds[engine], seconds['sax'] / seconds[engine], len(results[engine]), status))
+
+if( mismatch_count > 0 ):
+    print('%i engine results differ from xml.sax' % mismatch_count)
+    sys.exit(1)
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+#
+# Reads .pepXML files with each msgfspecprob_mode of pepxml.py and reports the spectra
+# where the best hit chosen by pepxml2hit_list.py (see pepxml.best_hit) differs from the one chosen
+# with Decimal msgfspecprob values, plus the spectra where float rounding turns distinct values into ties
+#
+
+import sys
+import time
+
+# Import pepxml.py, which should be in the same directory as compare_msgfspecprob_modes.py
+import pepxml
+
+usage_mesg = 'Usage: compare_msgfspecprob_modes.py FileToProcess.pepXML [FileToProcess2.pepXML ...]'
+
+# Spectra with a different best hit that are listed for each mode
+MAX_LISTED = 10
+
+def best_hit_index(search_hits, mode):
+    best = pepxml.best_hit(search_hits, mode)
+    for index, search_hit in enumerate(search_hits):
+        if( search_hit is best ):
+            return index
+    return None
+
+if( len(sys.argv) < 2 ):
+    print(usage_mesg)
+    sys.exit(1)
+
+difference_count = 0
+for filename_pepxml in sys.argv[1:]:
+    print('Reading %s' % filename_pepxml)
+
+    results = dict()
+    seconds = dict()
+    for mode in ['decimal', 'float', 'log10']:
+        start_time = time.perf_counter()
+        results[mode] = [(spectrum_id, spectrum_query['search_hit']) for spectrum_id, spectrum_query in
+                         pepxml.iter_spectrum_queries(filename_pepxml, msgfspecprob_mode=mode)]
+        seconds[mode] = time.perf_counter() - start_time
+
+    # Spectra where two hits have different Decimal values of msgfspecprob but the same float value
+    rounded_ties = 0
+    for spectrum_id, search_hits in results['decimal']:
+        values = set(search_hit['msgfspecprob'] for search_hit in search_hits if search_hit.get('msgfspecprob') is not None)
+        if( len(set(float(value) for value in values)) < len(values) ):
+            rounded_ties += 1
+
+    print('  %-8s %8.3f sec  %i spectra  %i with distinct msgfspecprob values that are equal as floats' % ('decimal', seconds['decimal'], len(results['decimal']), rounded_ties))
+
+    expected = [best_hit_index(search_hits, 'decimal') for spectrum_id, search_hits in results['decimal']]
+    for mode in ['float', 'log10']:
+        differences = []
+        for index, (spectrum_id, search_hits) in enumerate(results[mode]):
+            best = best_hit_index(search_hits, mode)
+            if( best != expected[index] ):
+                differences.append((spectrum_id, expected[index], best))
+
+        difference_count += len(differences)
+        print('  %-8s %8.3f sec  %i spectra  %i with a different best hit' % (mode, seconds[mode], len(results[mode]), len(differences)))
+        for spectrum_id, expected_hit, best in differences[:MAX_LISTED]:
+            print('    %s: hit %s with decimal, hit %s with %s' % (spectrum_id, expected_hit, best, mode))
+
+if( difference_count > 0 ):
+    print('%i best hits differ from the decimal msgfspecprob mode' % difference_count)
+    sys.exit(1)
@@ -7,130 +7,2481 @@
 # 2018-06-06 mem - Update to Python 3.x and update to support .pepXML files from MSFragger and MSGF+
 #
 
+import bz2
+import copy
+import gzip
+import heapq
+import lzma
+import math
+import mmap
+import os
+import queue
+import re
+import threading
 import xml.sax
+from xml.parsers import expat
+from collections.abc import ItemsView, Mapping, MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from decimal import Decimal, getcontext
+from functools import lru_cache, partial
+from itertools import groupby, islice, repeat
 
-class pepxml_parser(xml.sax.ContentHandler):
-    element_array = []
-    is_spectrum_query = False
-    is_search_hit = False
-    PSM = dict()
-    search_hit = dict()
-    spectrum_id = ''
+# lxml is optional; when it is installed, iterparse is used instead of xml.sax
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+ENGINES = ('lxml', 'expat', 'sax', 'known_writer')
+
+class slots_record(MutableMapping):
+    """
+    Base class for the spectrum query and search hit records
+
+    The fields listed in a subclass are stored in __slots__ instead of a per-object dictionary;
+    a field is absent until it is assigned, so the records behave like the dictionaries they replace
+    (record['expect'], record.get('expect'), 'expect' in record, record.items(), etc.) and compare equal to them
+
+    Keys that are not fields (such as the scores of other search engines) are kept in a small overflow dictionary,
+    which is only created when the record has such a key
+    """
+    __slots__ = ('extra',)
+    fields = ()
+    field_set = frozenset()
+
+    def __init__(self, values=None):
+        # values is an optional dictionary of the keys and values of the record
+        extra = None
+        if( values ):
+            field_set = self.field_set
+            for key, value in values.items():
+                if( key in field_set ):
+                    setattr(self, key, value)
+                elif( extra is None ):
+                    extra = {key: value}
+                else:
+                    extra[key] = value
+        self.extra = extra
+
+    def __getitem__(self, key):
+        if( key in self.field_set ):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if( self.extra is None ):
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if( key in self.field_set ):
+            setattr(self, key, value)
+        elif( self.extra is None ):
+            self.extra = {key: value}
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if( key in self.field_set ):
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif( self.extra is None ):
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for name in self.fields:
+            if( hasattr(self, name) ):
+                yield name
+        if( self.extra ):
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def __contains__(self, key):
+        if( key in self.field_set ):
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        if( key in self.field_set ):
+            return getattr(self, key, default)
+        if( self.extra is None ):
+            return default
+        return self.extra.get(key, default)
+
+    def items(self):
+        return slots_record_items(self)
+
+    def copy(self):
+        return type(self)(dict(self.items()))
+
+    def pack(self):
+        """
+        Return the record as a tuple (mask, extra, values of the fields that are set), to be sent to another process;
+        bit i of mask is set if fields[i] is set (a field can hold None, so absent fields cannot be stored as None)
+        """
+        mask = 0
+        packed = [0, self.extra]
+        for bit, name in enumerate(self.fields):
+            try:
+                packed.append(getattr(self, name))
+            except AttributeError:
+                continue
+            mask |= 1 << bit
+        packed[0] = mask
+        return tuple(packed)
+
+    @classmethod
+    def unpack(cls, packed):
+        """
+        Rebuild a record from the tuple returned by pack
+        """
+        record = cls.__new__(cls)
+        record.extra = packed[1]
+        for name, value in zip(packed_field_names(cls.fields, packed[0]), islice(packed, 2, None)):
+            setattr(record, name, value)
+        return record
+
+    def __eq__(self, other):
+        if( not isinstance(other, Mapping) ):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+class slots_record_items(ItemsView):
+    """
+    The items() view of a slots_record; iterating reads each field once, instead of testing it and then looking it up
+    """
+    def __iter__(self):
+        record = self._mapping
+        for name in record.fields:
+            try:
+                yield (name, getattr(record, name))
+            except AttributeError:
+                continue
+        if( record.extra ):
+            yield from record.extra.items()
+
+@lru_cache(maxsize=None)
+def packed_field_names(fields, mask):
+    """
+    Return the fields whose bits are set in the mask of a packed record (see slots_record.pack)
+    """
+    return tuple(name for bit, name in enumerate(fields) if mask >> bit & 1)
+
+class spectrum_query_record(slots_record):
+    """
+    The record stored in PSM[spectrum_id]
+
+    run is the msms_run that the spectrum query belongs to; it is an attribute rather than a key,
+    so it is not compared or listed with the fields of the spectrum query
+    """
+    fields = ('search_hit', 'charge', 'neutral_mass', 'start_scan', 'end_scan', 'retention_time_sec')
+    field_set = frozenset(fields)
+    __slots__ = fields + ('run',)
+
+    def copy(self):
+        record = slots_record.copy(self)
+        record.run = self.run
+        return record
+
+    def pack(self):
+        # The search hits are packed too; search_hit is the first field, so it is the first value when it is set
+        packed = slots_record.pack(self)
+        if( packed[0] & 1 ):
+            packed = packed[:2] + (tuple(search_hit.pack() for search_hit in packed[2]),) + packed[3:]
+        return packed
+
+    @classmethod
+    def unpack(cls, packed):
+        # run is not packed; the receiver assigns it
+        record = super().unpack(packed)
+        record.run = None
+        if( packed[0] & 1 ):
+            record.search_hit = [search_hit_record.unpack(search_hit) for search_hit in packed[2]]
+        return record
+
+class search_hit_record(slots_record):
+    """
+    A search hit in the search_hit list of a spectrum query
+
+    The fields are the attributes of the search_hit element and the scores reported by MS-GF+ and X! Tandem
+    (the search engines of the PeptideListToXML examples); every unset field still takes 8 bytes,
+    so other scores, alternative proteins and modifications go to the overflow dictionary
+    """
+    fields = ('hit_rank', 'peptide', 'protein', 'missed_cleavages', 'NumTrypticEnds', 'Ions_Matched', 'Ions_Observed',
+              'num_tot_proteins', 'expect', 'msgfspecprob', 'hyperscore', 'nextscore')
+    field_set = frozenset(fields)
+    __slots__ = fields
+
+class string_pool:
+    """
+    Interning pool for the peptide and protein names of the search hits
+
+    Each distinct value is stored once and shared by every search hit that has it,
+    and is given an integer code (in order of first appearance) that can be used in place of the string
+    By default each parse has its own pool; pass the same pool to several parses to share it across a batch of files
+    """
+    def __init__(self):
+        self.codes = dict()
+        self.values = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        """
+        Return the integer code for value, adding it to the pool if necessary
+        """
+        code = self.codes.get(value)
+        if( code is None ):
+            # Several threads can share a pool (see parse_many)
+            with self.lock:
+                code = self.codes.get(value)
+                if( code is None ):
+                    code = len(self.values)
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+    def intern(self, value):
+        """
+        Return the pooled copy of value
+        """
+        return self.values[self.code(value)]
+
+    def decode(self, codes):
+        """
+        Convert a sequence of codes back to strings
+        """
+        values = self.values
+        return [values[code] for code in codes]
+
+class unpooled_strings:
+    """
+    Used in place of a string_pool when the search hits are not kept after they are read (see pepxml2hit_list.py);
+    values are returned as they are, so memory does not grow with the number of distinct peptides and proteins
+    """
+    def intern(self, value):
+        return value
+
+# Search parameters that hold the precursor and fragment mass tolerances, for the search engines that PeptideListToXML
+# and TPP support (MS-GF+, X! Tandem, Comet, MSFragger, SEQUEST and Mascot)
+TOLERANCE_PARAMETERS = frozenset([
+    'PMTolerance', 'PrecursorMassTolerance',
+    'spectrum, parent monoisotopic mass error plus', 'spectrum, parent monoisotopic mass error minus',
+    'spectrum, parent monoisotopic mass error units', 'spectrum, fragment monoisotopic mass error',
+    'spectrum, fragment monoisotopic mass error units',
+    'peptide_mass_tolerance', 'peptide_mass_units', 'fragment_bin_tol', 'fragment_ion_tolerance',
+    'precursor_mass_lower', 'precursor_mass_upper', 'precursor_mass_units', 'precursor_true_tolerance', 'precursor_true_units',
+    'fragment_mass_tolerance', 'fragment_mass_units',
+    'TOL', 'TOLU', 'ITOL', 'ITOLU'])
+
+class msms_run:
+    """
+    One msms_run_summary of a .pepXML file; files merged by xinteract have one per input file
+
+    attributes holds the attributes of the msms_run_summary element (base_name, raw_data_type, raw_data, ...);
+    search_summary holds the attributes of its first search_summary element (search_engine, precursor_mass_type, ...),
+    and parameters the name and value of each parameter element in that search_summary
+
+    The other children of the search_summary are kept as dictionaries of their attributes:
+    search_database, enzymatic_search_constraint, and the aminoacid_modifications and terminal_modifications lists;
+    sample_enzyme holds the attributes of the sample_enzyme element, and enzyme_specificities its specificity elements
+    enzyme is the name of the sample_enzyme (or the enzyme of the enzymatic_search_constraint)
+    """
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.base_name = attributes.get('base_name')
+        self.raw_data_type = attributes.get('raw_data_type')
+        self.raw_data = attributes.get('raw_data')
+        self.search_summary = None
+        self.search_engine = None
+        self.parameters = dict()
+
+        self.sample_enzyme = None
+        self.enzyme = None
+        self.enzyme_specificities = []
+        self.search_database = None
+        self.enzymatic_search_constraint = None
+        self.aminoacid_modifications = []
+        self.terminal_modifications = []
+
+    def set_search_summary(self, attributes):
+        self.search_summary = attributes
+        self.search_engine = attributes.get('search_engine')
+
+    def set_sample_enzyme(self, attributes):
+        self.sample_enzyme = attributes
+        self.enzyme = attributes.get('name')
+
+    def add_header_element(self, name, attributes):
+        """
+        Store a child element of the search_summary or sample_enzyme (attributes is a dictionary)
+        """
+        if( name == 'parameter' ):
+            self.parameters[attributes.get('name')] = attributes.get('value')
+        elif( name == 'aminoacid_modification' ):
+            self.aminoacid_modifications.append(attributes)
+        elif( name == 'terminal_modification' ):
+            self.terminal_modifications.append(attributes)
+        elif( name == 'specificity' ):
+            self.enzyme_specificities.append(attributes)
+        elif( name == 'search_database' ):
+            self.search_database = attributes
+        elif( name == 'enzymatic_search_constraint' ):
+            self.enzymatic_search_constraint = attributes
+            if( self.enzyme is None ):
+                self.enzyme = attributes.get('enzyme')
+
+    def tolerances(self):
+        """
+        Return a dictionary of the mass tolerance parameters of the search (see TOLERANCE_PARAMETERS),
+        for example {'PMTolerance': '20ppm'} for MS-GF+
+        """
+        return {name: value for name, value in self.parameters.items() if name in TOLERANCE_PARAMETERS}
+
+    def __repr__(self):
+        return 'msms_run(base_name=%r, raw_data=%r, search_engine=%r)' % (self.base_name, self.raw_data, self.search_engine)
+
+def intern_search_hits(spectrum_query, pool):
+    """
+    Replace the peptide and protein names of the search hits, and their alternative proteins, with their pooled copies
+    """
+    for search_hit in spectrum_query['search_hit']:
+        for key in ('peptide', 'protein'):
+            value = search_hit.get(key)
+            if( value is not None ):
+                search_hit[key] = pool.intern(value)
+
+        alternative_proteins = search_hit.get(ALTERNATIVE_PROTEIN_FIELD)
+        if( alternative_proteins ):
+            search_hit[ALTERNATIVE_PROTEIN_FIELD] = [pool.intern(protein) for protein in alternative_proteins]
+
+def read_spectrum_query(attr, options=None):
+    """
+    Convert the attributes of a spectrum_query element into the spectrum_query_record stored in PSM[spectrum_id]
+
+    Only the fields selected in options (a parse_options) are converted
+    """
+    if( options is None ):
+        options = parse_options()
+
+    spectrum_query = spectrum_query_record()
+    spectrum_query.run = options.run
+    spectrum_query.search_hit = options.new_hit_list()
+    for key, attribute, converter in options.spectrum_query_fields:
+        setattr(spectrum_query, key, converter(attr[attribute]))
+    return spectrum_query
+
+def read_search_hit(attr, options=None):
+    """
+    Convert the attributes of a search_hit element into a search_hit_record
+
+    Only the fields selected in options (a parse_options) are converted;
+    the peptide and protein are interned in the string_pool of options
+    The engines then add the search scores and other child elements to the record (see add_search_score)
+    """
+    if( options is None ):
+        options = parse_options()
+
+    search_hit = search_hit_record()
+    for key, attribute, converter in options.search_hit_fields:
+        setattr(search_hit, key, converter(attr[attribute]))
+    return search_hit
+
+def read_msgfspecprob(value):
+    """
+    Return an msgfspecprob value as a Decimal (msgfspecprob_mode 'decimal'), keeping every digit of the text
+    """
+    # MSGF+ leaves msgfspecprob empty for some hits
+    if( value == '' ):
+        return None
+    return Decimal(value)
+
+def read_msgfspecprob_float(value):
+    """
+    Return an msgfspecprob value as a float (msgfspecprob_mode 'float', the default)
+    """
+    if( value == '' ):
+        return None
+    return float(value)
+
+def read_msgfspecprob_log10(value):
+    """
+    Return log10 of an msgfspecprob value (msgfspecprob_mode 'log10')
+
+    The exponent is taken from the text, so probabilities below the float range (about 1E-308) are not rounded to zero
+    """
+    if( value == '' ):
+        return None
+    mantissa, separator, exponent = value.upper().partition('E')
+    mantissa = float(mantissa)
+    if( mantissa <= 0 ):
+        return float('-inf')
+    return math.log10(mantissa) + int(exponent or 0)
+
+# Converters for the msgfspecprob search score, by msgfspecprob_mode (see parse_options)
+MSGFSPECPROB_CONVERTERS = {
+    'float': read_msgfspecprob_float,
+    'log10': read_msgfspecprob_log10,
+    'decimal': read_msgfspecprob}
+
+# Search scores that are stored in each search hit, keyed by the name attribute of the search_score element
+# Each entry is (key in the search hit record, function that converts the value attribute)
+# Scores that are not listed are skipped; use register_search_score to track additional scores
+SEARCH_SCORES = {
+    ## SEQUEST
+    'xcorr': ('xcorr', float),
+    'spscore': ('spscore', float),
+    'deltacn': ('deltacn', float),
+    'deltacnstar': ('deltacnstar', float),
+    'RankXc': ('RankXc', int),
+    'XcRatio': ('XcRatio', float),
+    'Ions_Observed': ('Ions_Observed', int),
+    'Ions_Expected': ('Ions_Expected', int),
+
+    ## X!Tandem and MSFragger
+    'hyperscore': ('hyperscore', float),
+    'nextscore': ('nextscore', float),
+    'expect': ('expect', float),
+
+    ## InsPecT
+    # InsPecT reports expect values; already handled above
+    'mqscore': ('mqscore', float),
+    'fscore': ('fscore', float),
+    'deltascore': ('deltascore', float),
+
+    ## MyriMatch
+    'mvh': ('mvh', float),
+    'massError': ('massError', float),
+    'mzSSE': ('mzSSE', float),
+    'mzFidelity': ('mzFidelity', float),
+    'newMZFidelity': ('newMZFidelity', float),
+    'mzMAE': ('mzMAE', float),
+
+    ## DirecTag-TagRecon
+    'numPTMs': ('numPTMs', int),
+
+    ## Generic additional
+    'NumTrypticEnds': ('NumTrypticEnds', int),
+
+    ## MSGF+
+    # Track MSGF+ EValues using 'expect' aka expectation value
+    'EValue': ('expect', float),
+    'msgfspecprob': ('msgfspecprob', read_msgfspecprob_float),
+}
+
+def register_search_score(name, key=None, converter=float):
+    """
+    Track an additional search score (or change how an existing one is stored)
+
+    key is the name used in the search hit record (by default, the score name);
+    converter is called with the value attribute, and can return None to skip the value
+
+    For example, to keep the MSGF+ FDR values:
+        pepxml.register_search_score('QValue')
+        pepxml.register_search_score('PepQValue')
+        pepxml.register_search_score('MSGFDB_SpecEValue', converter=Decimal)
+
+    The parse functions send a copy of SEARCH_SCORES to their worker processes, so registered scores are also read
+    when workers is more than 1; the converter must then be picklable (a built-in or a module-level function)
+    """
+    if( key is None ):
+        key = name
+    SEARCH_SCORES[name] = (key, converter)
+
+def unregister_search_score(name):
+    """
+    Stop tracking a search score; unknown names are ignored
+    """
+    SEARCH_SCORES.pop(name, None)
+
+def add_alternative_protein(search_hit, protein, options):
+    """
+    Add a protein from an alternative_protein element to search_hit['alternative_protein'],
+    unless the hit already has options.max_proteins proteins; the name is interned in the string_pool of options
+    """
+    alternative_proteins = search_hit.get('alternative_protein')
+    limit = options.max_alternative_proteins
+    if( alternative_proteins is None ):
+        if( limit != 0 ):
+            search_hit['alternative_protein'] = [options.pool.intern(protein)]
+    elif( limit is None or len(alternative_proteins) < limit ):
+        alternative_proteins.append(options.pool.intern(protein))
+
+def read_modification_info(search_hit, attr):
+    """
+    Store the terminal modification masses of a modification_info element (attr is a dictionary) in search_hit
+    """
+    value = attr.get('mod_nterm_mass')
+    if( value is not None ):
+        search_hit['mod_nterm_mass'] = float(value)
+    value = attr.get('mod_cterm_mass')
+    if( value is not None ):
+        search_hit['mod_cterm_mass'] = float(value)
+
+def add_mod_aminoacid_mass(search_hit, position, mass):
+    """
+    Add the position (1-based) and mass of a modified residue to search_hit['mod_aminoacid_mass']
+    """
+    modified_residues = search_hit.get('mod_aminoacid_mass')
+    if( modified_residues is None ):
+        search_hit['mod_aminoacid_mass'] = [(int(position), float(mass))]
+    else:
+        modified_residues.append((int(position), float(mass)))
+
+# Format of the masses in modified peptide sequences, for example M[147.035]
+MODIFIED_MASS_FORMAT = '[%.3f]'
+
+def insert_modification_labels(peptide, residue_labels, nterm_label=None, cterm_label=None):
+    """
+    Insert a label after each modified residue of peptide; residue_labels is a list of (position, label) tuples,
+    with 1-based positions. The terminal labels (if not None) are written as n[label] and c[label], as in TPP
+    """
+    if( residue_labels ):
+        parts = []
+        start = 0
+        for position, label in sorted(residue_labels):
+            parts.append(peptide[start:position])
+            parts.append(label)
+            start = position
+        parts.append(peptide[start:])
+        peptide = ''.join(parts)
+
+    if( nterm_label is not None ):
+        peptide = 'n' + nterm_label + peptide
+    if( cterm_label is not None ):
+        peptide = peptide + 'c' + cterm_label
+    return peptide
+
+def format_modified_peptide(peptide, modified_residues=None, nterm_mass=None, cterm_mass=None, mass_format=MODIFIED_MASS_FORMAT):
+    """
+    Return a peptide sequence with the mass of each modified residue after the residue, for example PEPM[147.035]K;
+    terminal modifications are written as n[43.018]PEPTIDE and PEPTIDEc[17.003]
+
+    modified_residues is a list of (position, mass) tuples, with 1-based positions (see add_mod_aminoacid_mass)
+    """
+    residue_labels = None
+    if( modified_residues ):
+        residue_labels = [(position, mass_format % mass) for position, mass in modified_residues]
+    nterm_label = None if nterm_mass is None else mass_format % nterm_mass
+    cterm_label = None if cterm_mass is None else mass_format % cterm_mass
+    return insert_modification_labels(peptide, residue_labels, nterm_label, cterm_label)
+
+def modified_peptide(search_hit, mass_format=MODIFIED_MASS_FORMAT):
+    """
+    Return the peptide of a search hit with its modifications (see format_modified_peptide)
+    """
+    return format_modified_peptide(search_hit['peptide'], search_hit.get('mod_aminoacid_mass'),
+                                   search_hit.get('mod_nterm_mass'), search_hit.get('mod_cterm_mass'), mass_format)
+
+def add_search_score(search_hit,name,value,search_scores=SEARCH_SCORES):
+    """
+    Store the value of a search_score element in search_hit, if it is a score listed in search_scores
+    (by default, SEARCH_SCORES; see parse_options for the scores selected by a parse)
+    """
+    score = search_scores.get(name)
+    if( score is None ):
+        return
+
+    key, converter = score
+    value = converter(value)
+    if( value is not None ):
+        search_hit[key] = value
+
+# Spectrum query fields: (key in the spectrum query dictionary, spectrum_query attribute, converter)
+SPECTRUM_QUERY_FIELDS = (
+    ('charge', 'assumed_charge', int),
+    ('neutral_mass', 'precursor_neutral_mass', float),
+    ('start_scan', 'start_scan', int),
+    ('end_scan', 'end_scan', int),
+    ('retention_time_sec', 'retention_time_sec', float))
+
+# Search hit fields: (key in the search hit record, search_hit attribute, converter)
+# A converter of None means the value is a string that is interned in the string_pool of the parse
+SEARCH_HIT_FIELDS = (
+    ('hit_rank', 'hit_rank', int),
+    ('peptide', 'peptide', None),
+    ('protein', 'protein', None),
+    ('missed_cleavages', 'num_missed_cleavages', int),
+    ('NumTrypticEnds', 'num_tol_term', int),
+    ('Ions_Matched', 'num_matched_ions', int),
+    ('Ions_Observed', 'tot_num_ions', int),
+    ('num_tot_proteins', 'num_tot_proteins', int))
+
+# Key for the probability of the peptideprophet_result element
+PEPTIDEPROPHET_FIELD = 'TPP_pep_prob'
+
+# Key for the list of protein names from the alternative_protein elements of a search hit
+# (the key is absent if a hit has none)
+ALTERNATIVE_PROTEIN_FIELD = 'alternative_protein'
+
+# Keys for the modification_info of a search hit: a list of (position, mass) tuples from the mod_aminoacid_mass elements,
+# and the mod_nterm_mass and mod_cterm_mass attributes; each key is absent if the hit does not have it
+# Selecting any of them in fields reads all three
+MODIFICATION_FIELDS = ('mod_aminoacid_mass', 'mod_nterm_mass', 'mod_cterm_mass')
+
+def available_fields(search_scores=None):
+    """
+    Names that can be passed in the fields list of parse_by_filename
+    (search_scores is the score table to list; by default, SEARCH_SCORES)
+    """
+    if( search_scores is None ):
+        search_scores = SEARCH_SCORES
+    names = [key for key, attribute, converter in SPECTRUM_QUERY_FIELDS]
+    names.extend(key for key, attribute, converter in SEARCH_HIT_FIELDS)
+    for key, converter in search_scores.values():
+        if( key not in names ):
+            names.append(key)
+    names.append(PEPTIDEPROPHET_FIELD)
+    names.append(ALTERNATIVE_PROTEIN_FIELD)
+    names.extend(MODIFICATION_FIELDS)
+    return names
+
+class psm_filter:
+    """
+    Filters applied while a .pepXML file is parsed, so that rejected spectra and hits are never stored
+
+    charges: keep only spectrum queries with one of these charges (like /ChargeFilter of PeptideListToXML)
+    max_hit_rank: keep only search hits with hit_rank <= max_hit_rank
+    max_scores: dictionary of score key to threshold, for example {'expect': 1E-5}; hits with a larger score are rejected
+    min_scores: dictionary of score key to threshold, for example {'xcorr': 2}; hits with a smaller score are rejected
+    peptides: keep only search hits whose peptide is in this collection (like /PepFilter of PeptideListToXML)
+    proteins: keep only search hits whose protein is in this collection
+
+    Hits that do not have a score listed in max_scores or min_scores are rejected
+    Charge, hit rank, peptide and protein are checked when the element starts, so rejected hits are skipped entirely;
+    score thresholds are checked when the search hit ends
+    When a hit filter is defined, spectrum queries without any accepted hits are dropped
+    Hits that pass the filters but are dropped by hits_per_spectrum (see parse_options) are counted separately,
+    so hits_kept is the number of hits returned
+
+    Counts of the spectra and hits read and rejected are accumulated across parses; see report()
+    """
+    # Counters reported by report(), and merged by add_statistics
+    STATISTICS = ('spectra_read', 'spectra_rejected_charge', 'spectra_without_hits', 'spectra_kept',
+                  'hits_read', 'hits_rejected_hit_rank', 'hits_rejected_peptide', 'hits_rejected_protein',
+                  'hits_rejected_score', 'hits_beyond_limit', 'hits_kept')
+
+    def __init__(self, charges=None, max_hit_rank=None, max_scores=None, min_scores=None, peptides=None, proteins=None):
+        self.charges = None if charges is None else frozenset(charges)
+        self.max_hit_rank = max_hit_rank
+        self.max_scores = dict(max_scores or {})
+        self.min_scores = dict(min_scores or {})
+        self.peptides = None if peptides is None else frozenset(peptides)
+        self.proteins = None if proteins is None else frozenset(proteins)
+
+        self.filters_hits = ( max_hit_rank is not None or self.max_scores or self.min_scores or
+                              self.peptides is not None or self.proteins is not None )
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        for name in self.STATISTICS:
+            setattr(self, name, 0)
+
+    def statistics(self):
+        return {name: getattr(self, name) for name in self.STATISTICS}
+
+    def add_statistics(self, statistics):
+        """
+        Add the counts of another filter (for example, from a worker process)
+        """
+        for name in self.STATISTICS:
+            setattr(self, name, getattr(self, name) + statistics[name])
+
+    def score_keys(self):
+        return set(self.max_scores).union(self.min_scores)
+
+    def accept_spectrum_query(self, attr):
+        """
+        Check the attributes of a spectrum_query element
+        """
+        self.spectra_read += 1
+        if( self.charges is not None and int(attr['assumed_charge']) not in self.charges ):
+            self.spectra_rejected_charge += 1
+            return False
+        return True
+
+    def accept_search_hit(self, attr):
+        """
+        Check the attributes of a search_hit element
+        """
+        self.hits_read += 1
+        if( self.max_hit_rank is not None and int(attr['hit_rank']) > self.max_hit_rank ):
+            self.hits_rejected_hit_rank += 1
+            return False
+        if( self.peptides is not None and attr['peptide'] not in self.peptides ):
+            self.hits_rejected_peptide += 1
+            return False
+        if( self.proteins is not None and attr['protein'] not in self.proteins ):
+            self.hits_rejected_protein += 1
+            return False
+        return True
+
+    def accept_scores(self, search_hit):
+        """
+        Check the scores of a completed search hit
+        """
+        for key, threshold in self.max_scores.items():
+            value = search_hit.get(key)
+            if( value is None or value > threshold ):
+                self.hits_rejected_score += 1
+                return False
+        for key, threshold in self.min_scores.items():
+            value = search_hit.get(key)
+            if( value is None or value < threshold ):
+                self.hits_rejected_score += 1
+                return False
+        return True
 
+    def accept_hits(self, spectrum_query):
+        """
+        Check a completed spectrum query, after its hits were limited to hits_per_spectrum;
+        it is dropped if hits are filtered and none were accepted
+        """
+        search_hits = spectrum_query['search_hit']
+        if( self.filters_hits and not search_hits ):
+            self.spectra_without_hits += 1
+            return False
+        self.spectra_kept += 1
+        self.hits_kept += len(search_hits)
+        return True
+
+    def describe(self):
+        conditions = []
+        if( self.charges is not None ):
+            conditions.append('charge in %s' % ', '.join(str(charge) for charge in sorted(self.charges)))
+        if( self.max_hit_rank is not None ):
+            conditions.append('hit_rank <= %s' % self.max_hit_rank)
+        for key, threshold in self.max_scores.items():
+            conditions.append('%s <= %s' % (key, threshold))
+        for key, threshold in self.min_scores.items():
+            conditions.append('%s >= %s' % (key, threshold))
+        if( self.peptides is not None ):
+            conditions.append('peptide in list of %i' % len(self.peptides))
+        if( self.proteins is not None ):
+            conditions.append('protein in list of %i' % len(self.proteins))
+        return '; '.join(conditions) or 'none'
+
+    def report(self):
+        """
+        Return a summary of the filters and how many spectra and hits they kept
+        """
+        def percent(count, total):
+            if( total == 0 ):
+                return 0.0
+            return 100.0 * count / total
+
+        lines = ['Filters: %s' % self.describe()]
+        lines.append('  Spectra: %i read, %i rejected by charge, %i without accepted hits, %i kept (%.1f%%)' % (
+            self.spectra_read, self.spectra_rejected_charge, self.spectra_without_hits,
+            self.spectra_kept, percent(self.spectra_kept, self.spectra_read)))
+        lines.append('  Hits:    %i read, %i rejected by hit rank, %i by peptide, %i by protein, %i by score, %i beyond hits_per_spectrum, %i kept (%.1f%%)' % (
+            self.hits_read, self.hits_rejected_hit_rank, self.hits_rejected_peptide, self.hits_rejected_protein,
+            self.hits_rejected_score, self.hits_beyond_limit, self.hits_kept, percent(self.hits_kept, self.hits_read)))
+        return '\n'.join(lines)
+
+# Scores for which a smaller value is better; other scores are ranked largest first (see top_hit_list)
+LOWER_IS_BETTER = frozenset(['hit_rank', 'expect', 'msgfspecprob', 'RankXc', 'QValue', 'PepQValue', 'MSGFDB_SpecEValue'])
+
+class top_hit_list:
+    """
+    Stands in for the search_hit list of a spectrum query while it is parsed, keeping only the best count hits
+
+    The hits are ranked by rank_by (a search hit key); if descending is None, the direction comes from LOWER_IS_BETTER
+    A bounded heap holds at most count hits; ties are won by the hit that comes first in the file,
+    and hits without the score are ranked last
+    hits() returns the hits that were kept, in file order
+    """
+    def __init__(self, count, rank_by='hit_rank', descending=None):
+        if( descending is None ):
+            descending = rank_by not in LOWER_IS_BETTER
+        self.count = count
+        self.rank_by = rank_by
+        self.descending = descending
+        self.heap = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def append(self, search_hit):
+        # The heap is ordered worst first: (has score, score, later hits first)
+        value = search_hit.get(self.rank_by)
+        if( value is None ):
+            entry = (0, 0, -self.sequence, search_hit)
+        elif( self.descending ):
+            entry = (1, value, -self.sequence, search_hit)
+        else:
+            entry = (1, -value, -self.sequence, search_hit)
+        self.sequence += 1
+
+        if( len(self.heap) < self.count ):
+            heapq.heappush(self.heap, entry)
+        else:
+            heapq.heappushpop(self.heap, entry)
+
+    def hits(self):
+        return [entry[3] for entry in sorted(self.heap, key=lambda entry: -entry[2])]
+
+## Best hit of a spectrum, as chosen by pepxml2hit_list.py
+
+# Scores used by pepxml2hit_list.py to choose the best hit of each spectrum, in order of precedence,
+# with the value used when a hit does not have the score
+BEST_HIT_SCORES = (
+    ('msgfspecprob', 1),
+    ('expect', 1),
+    ('xcorr', 0))
+
+def best_hit_scores(msgfspecprob_mode=None):
+    """
+    Return BEST_HIT_SCORES for values read with msgfspecprob_mode; log10 msgfspecprob values default to 0
+    """
+    if( msgfspecprob_mode == 'log10' ):
+        return (('msgfspecprob', 0),) + BEST_HIT_SCORES[1:]
+    return BEST_HIT_SCORES
+
+def cascade_best_hit(hits, msgfspecprob_limit=1):
+    """
+    Return the index of the best hit in hits, a list of (msgfspecprob, expect, xcorr) tuples in file order
+
+    This is the selection made by pepxml2hit_list.py: after the first hit, a hit replaces the current best hit
+    if the best hit has msgfspecprob < 1 and the hit has a smaller msgfspecprob; otherwise, if the best hit has expect < 1
+    and the hit has a smaller expect; otherwise, if the best hit has xcorr > 0 and the hit has a larger xcorr
+    Ties keep the earlier hit
+
+    Use msgfspecprob_limit=0 for log10 msgfspecprob values
+    """
+    best = 0
+    best_msgfspecprob, best_expect, best_xcorr = hits[0]
+    for index in range(1, len(hits)):
+        msgfspecprob, expect, xcorr = hits[index]
+        if( best_msgfspecprob < msgfspecprob_limit ):
+            store_hit = msgfspecprob < best_msgfspecprob
+        elif( best_expect < 1 ):
+            store_hit = expect < best_expect
+        elif( best_xcorr > 0 ):
+            store_hit = xcorr > best_xcorr
+        else:
+            store_hit = False
+
+        if( store_hit ):
+            best = index
+            best_msgfspecprob, best_expect, best_xcorr = hits[index]
+    return best
+
+def best_hit(search_hits, msgfspecprob_mode=None):
+    """
+    Return the best of a list of search hits (see cascade_best_hit), or None if the list is empty
+
+    msgfspecprob_mode is the mode the hits were read with (see parse_options)
+    """
+    if( not search_hits ):
+        return None
+    scores = best_hit_scores(msgfspecprob_mode)
+    values = [tuple(search_hit.get(name, default) for name, default in scores) for search_hit in search_hits]
+    return search_hits[cascade_best_hit(values, scores[0][1])]
+
+class parse_options:
+    """
+    Settings shared by the element handlers of one parse
+
+    fields is None to read every field, or a list of the spectrum query, search hit and search score keys to read
+    (see available_fields); the values of other attributes and search scores are never converted or stored
+    The spectrum ID and the search_hit list are always included
+
+    pool is the string_pool for the peptide and protein names; by default a new pool is used
+
+    hit_filter is an optional psm_filter; the scores it tests are read even if they are not in fields
+
+    hits_per_spectrum limits the number of search hits kept for each spectrum query, ranked by the rank_by key
+    (see top_hit_list); rank_by is read even if it is not in fields
+
+    msgfspecprob_mode selects how msgfspecprob values are stored: 'float' (the default, set in SEARCH_SCORES),
+    'log10' for the base 10 logarithm (which does not underflow for very small probabilities),
+    or 'decimal' for Decimal values with every digit of the text
+    psm_filter thresholds and rank_by comparisons for msgfspecprob use the same representation
+
+    max_proteins limits the number of proteins kept for each search hit, counting the protein attribute
+    and the alternative_protein elements (like /MaxProteins of PeptideListToXML); num_tot_proteins is not changed
+
+    search_scores is the table of search scores to read (see SEARCH_SCORES, the default); the parse functions
+    pass a copy of SEARCH_SCORES to their worker processes, which do not see scores registered in the parent
+
+    run is the msms_run that is being read; the engines replace it as each msms_run_summary opens
+    """
+    def __init__(self, fields=None, pool=None, hit_filter=None, hits_per_spectrum=None, rank_by='hit_rank', rank_descending=None,
+                 msgfspecprob_mode=None, max_proteins=None, search_scores=None):
+        if( search_scores is None ):
+            search_scores = SEARCH_SCORES
+        if( pool is None ):
+            pool = string_pool()
+        self.pool = pool
+        self.fields = fields
+        self.hit_filter = hit_filter
+
+        if( hits_per_spectrum is not None and hits_per_spectrum < 1 ):
+            raise ValueError("hits_per_spectrum must be at least 1")
+        self.hits_per_spectrum = hits_per_spectrum
+        self.rank_by = rank_by
+        self.rank_descending = rank_descending
+
+        requested = set()
+        if( fields is not None ):
+            requested.update(fields)
+        if( hit_filter is not None ):
+            requested.update(hit_filter.score_keys())
+        if( hits_per_spectrum is not None ):
+            requested.add(rank_by)
+        unknown = requested.difference(available_fields(search_scores))
+        if( unknown ):
+            raise ValueError("Unknown pepXML fields: %s" % ', '.join(sorted(unknown)))
+
+        if( fields is None ):
+            selected = None
+        else:
+            selected = requested
+
+        def is_selected(key):
+            return selected is None or key in selected
+
+        self.spectrum_query_fields = [field for field in SPECTRUM_QUERY_FIELDS if is_selected(field[0])]
+        self.search_hit_fields = [(key, attribute, converter or pool.intern)
+                                  for key, attribute, converter in SEARCH_HIT_FIELDS if is_selected(key)]
+
+        if( selected is None ):
+            self.search_scores = search_scores
+        else:
+            self.search_scores = {name: score for name, score in search_scores.items() if score[0] in selected}
+
+        self.msgfspecprob_mode = msgfspecprob_mode
+        if( msgfspecprob_mode is not None ):
+            converter = MSGFSPECPROB_CONVERTERS.get(msgfspecprob_mode)
+            if( converter is None ):
+                raise ValueError("Unknown msgfspecprob_mode: %s (use %s)" % (msgfspecprob_mode, ', '.join(MSGFSPECPROB_CONVERTERS)))
+            self.search_scores = {name: (key, converter if key == 'msgfspecprob' else score_converter)
+                                  for name, (key, score_converter) in self.search_scores.items()}
+
+        self.peptideprophet = is_selected(PEPTIDEPROPHET_FIELD)
+        self.alternative_proteins = is_selected(ALTERNATIVE_PROTEIN_FIELD)
+        self.modifications = any(is_selected(key) for key in MODIFICATION_FIELDS)
+
+        if( max_proteins is None ):
+            self.max_alternative_proteins = None
+        elif( max_proteins < 1 ):
+            raise ValueError("max_proteins must be at least 1")
+        else:
+            self.max_alternative_proteins = max_proteins - 1
+
+        self.run = None
+
+    def new_hit_list(self):
+        if( self.hits_per_spectrum is None ):
+            return []
+        return top_hit_list(self.hits_per_spectrum, self.rank_by, self.rank_descending)
+
+    def end_spectrum_query(self, spectrum_query):
+        """
+        Called when a spectrum query has been read; returns False if the spectrum query should be dropped
+        """
+        if( self.hits_per_spectrum is not None ):
+            top_hits = spectrum_query.search_hit
+            spectrum_query.search_hit = top_hits.hits()
+            if( self.hit_filter is not None ):
+                self.hit_filter.hits_beyond_limit += top_hits.sequence - len(spectrum_query.search_hit)
+        return self.hit_filter is None or self.hit_filter.accept_hits(spectrum_query)
+
+def merge_spectrum_query(PSM,spectrum_id,spectrum_query):
+    """
+    Add a parsed spectrum query to PSM; if the spectrum is already present, its search hits are appended
+    """
+    if( spectrum_id not in PSM ):
+        PSM[spectrum_id] = spectrum_query
+        return
+
+    print("Duplicate PSM : %s"%spectrum_id)
+    search_hits = PSM[spectrum_id]['search_hit']
+    search_hits.extend(spectrum_query['search_hit'])
+    PSM[spectrum_id].update(spectrum_query)
+    PSM[spectrum_id]['search_hit'] = search_hits
+
+## Element state machine for the xml.sax and pyexpat engines
+
+# Parse states; each is entered when a tracked element opens and left when that element closes
+STATE_OUTSIDE = 0           # not in a spectrum_query
+STATE_SPECTRUM_QUERY = 1    # in a spectrum_query that is being read
+STATE_SEARCH_HIT = 2        # in a search_hit that is being read
+STATE_SKIPPED = 3           # in a spectrum_query or search_hit rejected by the hit_filter
+STATE_RUN_HEADER = 4        # in the sample_enzyme or search_summary of the current msms_run_summary
+
+class pepxml_element_handler:
+    """
+    Tracks the spectrum_query, search_hit, search_score and peptideprophet_result elements
+    with an integer depth and a parse state instead of a stack of element names;
+    outside of spectrum queries, the msms_run_summary and search_summary elements update options.run
+
+    Each state has its own start element handler, which only tests for the elements that matter in that state;
+    the handlers are bound once per parse (start_handlers, indexed by state) and switched when the state changes.
+    The tracked elements are found by their parent, not their depth, so extra wrapper elements
+    (or a search_result at another level) do not matter: spectrum_query can be anywhere,
+    search_hit anywhere in a spectrum_query (normally in search_result), search_score must be a child of search_hit,
+    and peptideprophet_result can be anywhere in a search_hit (normally in analysis_result)
+
+    Subclasses provide the start handlers for the attribute format of their parser, and set_start_handler(handler),
+    which installs the start handler of a new state in their parser;
+    completed spectrum queries are passed to end_spectrum_query, which queues them in completed
+    """
+    def __init__(self, options=None):
+        # All parse state is per instance so that several files can be parsed at once
+        if( options is None ):
+            options = parse_options()
+        self.options = options
+        self.search_scores = options.search_scores
+        self.hit_filter = options.hit_filter
+        self.peptideprophet = options.peptideprophet
+        self.alternative_proteins = options.alternative_proteins
+        self.modifications = options.modifications
+
+        self.depth = 0
+        self.state = STATE_OUTSIDE
+        # Depth of the element that opened the current state, and the (state, depth) pairs of the enclosing states
+        self.state_depth = 0
+        self.enclosing_states = []
+        # Depth of the search_score elements of the current search hit
+        self.search_score_depth = 0
+
+        self.spectrum_id = ''
+        self.spectrum_query = None
+        self.search_hit = None
+        self.completed = []
+
+        self.start_handlers = (self.start_outside, self.start_in_spectrum_query, self.start_in_search_hit, self.start_skipped,
+                               self.start_in_run_header)
+
+    def enter_state(self, state):
+        self.enclosing_states.append((self.state, self.state_depth))
+        self.state = state
+        self.state_depth = self.depth
+        self.set_start_handler(self.start_handlers[state])
+
+    def start_run(self, attributes):
+        # attributes is a dictionary
+        self.options.run = msms_run(attributes)
+
+    def current_run(self):
+        run = self.options.run
+        if( run is None ):
+            # Not valid pepXML, but the search summary is still reported
+            run = msms_run(dict())
+            self.options.run = run
+        return run
+
+    def start_search_summary(self, attributes):
+        run = self.current_run()
+        if( run.search_summary is None ):
+            run.set_search_summary(attributes)
+            self.enter_state(STATE_RUN_HEADER)
+
+    def start_sample_enzyme(self, attributes):
+        run = self.current_run()
+        if( run.sample_enzyme is None ):
+            run.set_sample_enzyme(attributes)
+            self.enter_state(STATE_RUN_HEADER)
+
+    def start_spectrum_query(self, attr):
+        # attr is a dictionary (or the xml.sax attributes)
+        if( self.hit_filter is not None and not self.hit_filter.accept_spectrum_query(attr) ):
+            self.enter_state(STATE_SKIPPED)
+            return
+        self.spectrum_id = attr['spectrum']
+        self.spectrum_query = read_spectrum_query(attr, self.options)
+        self.enter_state(STATE_SPECTRUM_QUERY)
+
+    def start_search_hit(self, attr):
+        if( self.hit_filter is not None and not self.hit_filter.accept_search_hit(attr) ):
+            self.enter_state(STATE_SKIPPED)
+            return
+        self.search_hit = read_search_hit(attr, self.options)
+        self.enter_state(STATE_SEARCH_HIT)
+        self.search_score_depth = self.depth + 1
+
+    def end_state(self):
+        state = self.state
+        if( state == STATE_SEARCH_HIT ):
+            if( self.hit_filter is None or self.hit_filter.accept_scores(self.search_hit) ):
+                self.spectrum_query.search_hit.append(self.search_hit)
+            self.search_hit = None
+        elif( state == STATE_SPECTRUM_QUERY ):
+            if( self.options.end_spectrum_query(self.spectrum_query) ):
+                self.end_spectrum_query(self.spectrum_id, self.spectrum_query)
+            self.spectrum_id = ''
+            self.spectrum_query = None
+
+        self.state, self.state_depth = self.enclosing_states.pop()
+        self.set_start_handler(self.start_handlers[self.state])
+
+    def end_spectrum_query(self,spectrum_id,spectrum_query):
+        # Called each time a </spectrum_query> closes
+        self.completed.append((spectrum_id, spectrum_query))
+
+class pepxml_parser(pepxml_element_handler, xml.sax.ContentHandler):
     getcontext().prec = 32
 
-    def startElement(self,name,attr):
-        self.element_array.append(name)
-        if( len(self.element_array) == 3 and name == 'spectrum_query' ):
-            self.is_spectrum_query = True
-            self.spectrum_id = attr['spectrum']
-            if( self.spectrum_id not in self.PSM ):
-                self.PSM[self.spectrum_id] = dict()
-                self.PSM[self.spectrum_id]['search_hit'] = []
-            else:
-                print("Duplicate PSM : %s"%self.spectrum_id)
-                
-            self.PSM[self.spectrum_id]['charge'] = int(attr['assumed_charge'])
-            self.PSM[self.spectrum_id]['neutral_mass'] = float(attr['precursor_neutral_mass'])
-
-            self.PSM[self.spectrum_id]['start_scan'] = int(attr['start_scan'])
-            self.PSM[self.spectrum_id]['end_scan'] = int(attr['end_scan'])
-            self.PSM[self.spectrum_id]['retention_time_sec'] = float(attr['retention_time_sec'])
-
-        if( len(self.element_array) == 5 and name == 'search_hit' ):
-            self.is_search_hit = True
-            self.search_hit = dict()
-            self.search_hit['hit_rank'] = int(attr['hit_rank'])
-            self.search_hit['peptide'] = attr['peptide']
-            self.search_hit['protein'] = attr['protein']
-            self.search_hit['missed_cleavages'] = int(attr['num_missed_cleavages'])
-            self.search_hit['NumTrypticEnds'] = int(attr['num_tol_term'])
-            self.search_hit['Ions_Matched'] = int(attr['num_matched_ions'])
-            self.search_hit['Ions_Observed'] = int(attr['tot_num_ions'])
-
-        if( len(self.element_array) == 6 and name == 'search_score' ):
-            ## SEQUEST
-            if(attr['name'] == 'xcorr'):
-                self.search_hit['xcorr'] = float(attr['value'])
-            if(attr['name'] == 'spscore'):
-                self.search_hit['spscore'] = float(attr['value'])
-            if(attr['name'] == 'deltacn'):
-                self.search_hit['deltacn'] = float(attr['value'])
-            if(attr['name'] == 'deltacnstar'):
-                self.search_hit['deltacnstar'] = float(attr['value'])
-            if(attr['name'] == 'RankXc'):
-                self.search_hit['RankXc'] = int(attr['value'])
-            if(attr['name'] == 'XcRatio'):
-                self.search_hit['XcRatio'] = float(attr['value'])
-            if(attr['name'] == 'Ions_Observed'):
-                self.search_hit['Ions_Observed'] = int(attr['value'])
-            if(attr['name'] == 'Ions_Expected'):
-                self.search_hit['Ions_Expected'] = int(attr['value'])
-
-            ## X!Tandem and MSFragger
-            if(attr['name'] == 'hyperscore'):
-                self.search_hit['hyperscore'] = float(attr['value'])
-            if(attr['name'] == 'nextscore'):
-                self.search_hit['nextscore'] = float(attr['value'])
-            if(attr['name'] == 'expect'):
-                self.search_hit['expect'] = float(attr['value'])
-                
-            ## InsPecT
-            if(attr['name'] == 'mqscore'):
-                self.search_hit['mqscore'] = float(attr['value'])
-            # InsPecT reports expect values; already handled above
-            if(attr['name'] == 'fscore'):
-                self.search_hit['fscore'] = float(attr['value'])
-            if(attr['name'] == 'deltascore'):
-                self.search_hit['deltascore'] = float(attr['value'])
-
-            ## MyriMatch
-            if(attr['name'] == 'mvh'):
-                self.search_hit['mvh'] = float(attr['value'])
-            if(attr['name'] == 'massError'):
-                self.search_hit['massError'] = float(attr['value'])
-            if(attr['name'] == 'mzSSE'):
-                self.search_hit['mzSSE'] = float(attr['value'])
-            if(attr['name'] == 'mzFidelity'):
-                self.search_hit['mzFidelity'] = float(attr['value'])
-            if(attr['name'] == 'newMZFidelity'):
-                self.search_hit['newMZFidelity'] = float(attr['value'])
-            if(attr['name'] == 'mzMAE'):
-                self.search_hit['mzMAE'] = float(attr['value'])
-
-            ## DirecTag-TagRecon
-            if(attr['name'] == 'numPTMs'):
-                self.search_hit['numPTMs'] = int(attr['value'])
-
-            ## Generic additional
-            if(attr['name'] == 'NumTrypticEnds'):
-                self.search_hit['NumTrypticEnds'] = int(attr['value'])
-
-            ## MSGF+
-            # Track MSGF+ EValues using 'expect' aka expectation value
-            if(attr['name'] == 'EValue'):
-                self.search_hit['expect'] = float(attr['value'])
-
-            if(attr['name'] == 'msgfspecprob'):
-                if(attr['value'] != ''):
-                    self.search_hit['msgfspecprob'] = Decimal(attr['value'])
-       
+    def __init__(self, options=None):
+        pepxml_element_handler.__init__(self, options)
+        xml.sax.ContentHandler.__init__(self)
+        self.PSM = dict()
+        self.startElement = self.start_outside
+
+    def set_start_handler(self, handler):
+        # xml.sax looks up startElement for every element, so an instance attribute replaces the method
+        self.startElement = handler
+
+    def start_outside(self,name,attr):
+        self.depth += 1
+        if( name == 'spectrum_query' ):
+            self.start_spectrum_query(attr)
+        elif( name == 'msms_run_summary' ):
+            self.start_run(dict(attr))
+        elif( name == 'search_summary' ):
+            self.start_search_summary(dict(attr))
+        elif( name == 'sample_enzyme' ):
+            self.start_sample_enzyme(dict(attr))
+
+    def start_in_run_header(self,name,attr):
+        depth = self.depth + 1
+        self.depth = depth
+        # Only the children of the search_summary or sample_enzyme
+        if( depth == self.state_depth + 1 ):
+            self.options.run.add_header_element(name, dict(attr))
+
+    def start_in_spectrum_query(self,name,attr):
+        self.depth += 1
+        if( name == 'search_hit' ):
+            self.start_search_hit(attr)
+
+    def start_in_search_hit(self,name,attr):
+        depth = self.depth + 1
+        self.depth = depth
+        if( name == 'search_score' ):
+            if( depth == self.search_score_depth ):
+                add_search_score(self.search_hit, attr['name'], attr['value'], self.search_scores)
+
+        elif( name == 'alternative_protein' ):
+            if( depth == self.search_score_depth and self.alternative_proteins ):
+                add_alternative_protein(self.search_hit, attr['protein'], self.options)
+
+        elif( name == 'mod_aminoacid_mass' ):
+            if( depth == self.search_score_depth + 1 and self.modifications ):
+                add_mod_aminoacid_mass(self.search_hit, attr['position'], attr['mass'])
+
+        elif( name == 'modification_info' ):
+            if( depth == self.search_score_depth and self.modifications ):
+                read_modification_info(self.search_hit, attr)
+
         ## PeptideProphet
-        if( len(self.element_array) == 7 and name == 'peptideprophet_result' ):
+        elif( name == 'peptideprophet_result' and self.peptideprophet ):
             self.search_hit['TPP_pep_prob'] = float(attr['probability'])
 
+    def start_skipped(self,name,attr):
+        self.depth += 1
+
     def endElement(self,name):
-        if( len(self.element_array) == 3 and name == 'spectrum_query' ):
-            self.spectrum_id = ''
-            self.is_spectrum_query = False
-        if( len(self.element_array) == 5 and name == 'search_hit' ):
-            self.PSM[self.spectrum_id]['search_hit'].append(self.search_hit)
-            self.search_hit = dict()
-            self.is_search_hit = False
-        self.element_array.pop()
-    
-def parse_by_filename(filename_pepxml):
-    p = pepxml_parser()
-    xml.sax.parse(filename_pepxml,p)
-    return p.PSM
+        depth = self.depth
+        self.depth = depth - 1
+        if( depth == self.state_depth ):
+            self.end_state()
+
+    def end_spectrum_query(self,spectrum_id,spectrum_query):
+        merge_spectrum_query(self.PSM, spectrum_id, spectrum_query)
+
+class pepxml_stream_parser(pepxml_parser):
+    """
+    Variant of pepxml_parser that queues each spectrum query as soon as it closes,
+    instead of accumulating them in PSM
+    """
+    end_spectrum_query = pepxml_element_handler.end_spectrum_query
+
+def attribute_dict(attributes):
+    """
+    Convert the flat [name, value, name, value, ...] attribute list reported by pyexpat
+    (when ordered_attributes is enabled) into a dictionary
+    """
+    return dict(zip(attributes[0::2], attributes[1::2]))
+
+class pepxml_expat_handler(pepxml_element_handler):
+    """
+    Element handlers for a pyexpat parser, bypassing the xml.sax layer
+
+    Uses the same state machine as pepxml_parser, but reads attributes from pyexpat's ordered attribute lists,
+    so no dictionaries are created for search_score elements or for the elements we skip;
+    completed spectrum queries are queued in completed
+    """
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.parsers = []
+
+    def set_start_handler(self, handler):
+        for parser in self.parsers:
+            parser.StartElementHandler = handler
+
+    def start_outside(self,name,attributes):
+        self.depth += 1
+        if( name == 'spectrum_query' ):
+            self.start_spectrum_query(attribute_dict(attributes))
+        elif( name == 'msms_run_summary' ):
+            self.start_run(attribute_dict(attributes))
+        elif( name == 'search_summary' ):
+            self.start_search_summary(attribute_dict(attributes))
+        elif( name == 'sample_enzyme' ):
+            self.start_sample_enzyme(attribute_dict(attributes))
+
+    def start_in_run_header(self,name,attributes):
+        depth = self.depth + 1
+        self.depth = depth
+        # Only the children of the search_summary or sample_enzyme
+        if( depth == self.state_depth + 1 ):
+            self.options.run.add_header_element(name, attribute_dict(attributes))
+
+    def start_in_spectrum_query(self,name,attributes):
+        self.depth += 1
+        if( name == 'search_hit' ):
+            self.start_search_hit(attribute_dict(attributes))
+
+    def start_in_search_hit(self,name,attributes):
+        depth = self.depth + 1
+        self.depth = depth
+        if( name == 'search_score' ):
+            if( depth == self.search_score_depth ):
+                # PepXMLWriter (and most other writers) list name before value
+                if( attributes[0] == 'name' and attributes[2] == 'value' ):
+                    add_search_score(self.search_hit, attributes[1], attributes[3], self.search_scores)
+                else:
+                    attr = attribute_dict(attributes)
+                    add_search_score(self.search_hit, attr['name'], attr['value'], self.search_scores)
+
+        elif( name == 'alternative_protein' ):
+            if( depth == self.search_score_depth and self.alternative_proteins ):
+                add_alternative_protein(self.search_hit, attribute_dict(attributes)['protein'], self.options)
+
+        elif( name == 'mod_aminoacid_mass' ):
+            if( depth == self.search_score_depth + 1 and self.modifications ):
+                attr = attribute_dict(attributes)
+                add_mod_aminoacid_mass(self.search_hit, attr['position'], attr['mass'])
+
+        elif( name == 'modification_info' ):
+            if( depth == self.search_score_depth and self.modifications ):
+                read_modification_info(self.search_hit, attribute_dict(attributes))
+
+        ## PeptideProphet
+        elif( name == 'peptideprophet_result' and self.peptideprophet ):
+            self.search_hit['TPP_pep_prob'] = float(attribute_dict(attributes)['probability'])
+
+    def start_skipped(self,name,attributes):
+        self.depth += 1
+
+    def end_element(self,name):
+        depth = self.depth
+        self.depth = depth - 1
+        if( depth == self.state_depth ):
+            self.end_state()
+
+    def create_parser(self, encoding=None):
+        parser = expat.ParserCreate(encoding, intern=dict())
+        parser.ordered_attributes = True
+        parser.specified_attributes = True
+        parser.buffer_text = True
+        parser.buffer_size = EXPAT_BUFFER_SIZE
+        parser.StartElementHandler = self.start_handlers[self.state]
+        parser.EndElementHandler = self.end_element
+        self.parsers.append(parser)
+        return parser
+
+def read_spectrum_query_element(element, options=None):
+    """
+    Convert a spectrum_query element from lxml, including its search hits, into a
+    (spectrum_id, spectrum_query) tuple, matching what pepxml_parser creates
+
+    spectrum_query is None if the spectrum query is rejected by the hit_filter of options
+    """
+    # pepXML files normally declare a default namespace; element tags are of the form {namespace}spectrum_query
+    namespace = element.tag[:-len('spectrum_query')]
+    tag_search_hit = namespace + 'search_hit'
+    tag_search_score = namespace + 'search_score'
+    tag_alternative_protein = namespace + 'alternative_protein'
+    tag_modification_info = namespace + 'modification_info'
+    tag_mod_aminoacid_mass = namespace + 'mod_aminoacid_mass'
+    tag_peptideprophet_result = namespace + 'peptideprophet_result'
+
+    spectrum_id = element.get('spectrum')
+    if( options is None ):
+        options = parse_options()
+    search_scores = options.search_scores
+    hit_filter = options.hit_filter
+
+    if( hit_filter is not None and not hit_filter.accept_spectrum_query(element.attrib) ):
+        return spectrum_id, None
+
+    spectrum_query = read_spectrum_query(element.attrib, options)
+
+    # As in pepxml_element_handler, search hits can be at any depth (normally in search_result),
+    # and peptideprophet_result at any depth in a search hit (normally in analysis_result)
+    for hit_element in element.iter(tag_search_hit):
+        if( hit_filter is not None and not hit_filter.accept_search_hit(hit_element.attrib) ):
+            continue
+
+        search_hit = read_search_hit(hit_element.attrib, options)
+        for child in hit_element:
+            if( child.tag == tag_search_score ):
+                add_search_score(search_hit, child.get('name'), child.get('value'), search_scores)
+            elif( child.tag == tag_alternative_protein and options.alternative_proteins ):
+                add_alternative_protein(search_hit, child.get('protein'), options)
+            elif( child.tag == tag_modification_info and options.modifications ):
+                read_modification_info(search_hit, child.attrib)
+                for modified_residue in child.iterchildren(tag_mod_aminoacid_mass):
+                    add_mod_aminoacid_mass(search_hit, modified_residue.get('position'), modified_residue.get('mass'))
+
+        ## PeptideProphet
+        if( options.peptideprophet ):
+            for peptideprophet_result in hit_element.iter(tag_peptideprophet_result):
+                search_hit['TPP_pep_prob'] = float(peptideprophet_result.get('probability'))
+
+        if( hit_filter is None or hit_filter.accept_scores(search_hit) ):
+            spectrum_query.search_hit.append(search_hit)
+
+    if( not options.end_spectrum_query(spectrum_query) ):
+        return spectrum_id, None
+
+    return spectrum_id, spectrum_query
+
+def read_run_element(element):
+    """
+    Convert an msms_run_summary element from lxml into an msms_run, matching what pepxml_element_handler creates
+    """
+    namespace = element.tag[:-len('msms_run_summary')]
+    run = msms_run(dict(element.attrib))
+
+    sample_enzyme = next(element.iter(namespace + 'sample_enzyme'), None)
+    if( sample_enzyme is not None ):
+        run.set_sample_enzyme(dict(sample_enzyme.attrib))
+        read_run_header_children(run, sample_enzyme)
+
+    search_summary = next(element.iter(namespace + 'search_summary'), None)
+    if( search_summary is not None ):
+        run.set_search_summary(dict(search_summary.attrib))
+        read_run_header_children(run, search_summary)
+    return run
+
+def read_run_header_children(run, element):
+    # Child elements only (not comments), without their namespace
+    for child in element.iterchildren(tag=etree.Element):
+        run.add_header_element(child.tag.rpartition('}')[2], dict(child.attrib))
+
+def default_engine():
+    """
+    Name of the XML engine used when none is specified: lxml if it is installed, otherwise pyexpat
+    """
+    if( etree is not None ):
+        return 'lxml'
+    return 'expat'
+
+def check_engine(engine):
+    if( engine is None ):
+        return default_engine()
+    if( engine not in ENGINES ):
+        raise ValueError("Unknown pepXML parsing engine '%s'; should be one of %s" % (engine, ', '.join(ENGINES)))
+    if( engine == 'lxml' and etree is None ):
+        raise ValueError("The lxml engine was requested, but lxml is not installed")
+    return engine
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# The pyexpat engine reads the file in large blocks
+EXPAT_READ_BLOCK_SIZE = 1024 * 1024
+EXPAT_BUFFER_SIZE = 1024 * 1024
+
+## Compressed input
+
+# Leading bytes of each supported compression format
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'))
+
+COMPRESSION_OPENERS = {
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open}
+
+COMPRESSION_SUFFIX_RE = re.compile(r'\.(gz|bz2|xz)$', re.IGNORECASE)
+
+DECOMPRESS_BLOCK_SIZE = 1024 * 1024
+
+# Maximum number of decompressed blocks waiting to be parsed
+DECOMPRESS_QUEUE_SIZE = 8
+
+def detect_compression(filename_pepxml):
+    """
+    Return 'gzip', 'bz2' or 'xz' if the file starts with the magic bytes of that format, otherwise None
+    """
+    with open(filename_pepxml,'rb') as f_in:
+        magic = f_in.read(6)
+
+    for prefix, compression in COMPRESSION_MAGIC:
+        if( magic.startswith(prefix) ):
+            return compression
+    return None
+
+def strip_compression_suffix(filename):
+    """
+    Remove a trailing .gz, .bz2 or .xz from filename, e.g. Dataset.pepXML.gz becomes Dataset.pepXML
+    """
+    return COMPRESSION_SUFFIX_RE.sub('', filename)
+
+class threaded_decompressor:
+    """
+    Read-only binary file object for a gzip, bz2 or xz file
+
+    The file is decompressed on a background thread, which stays up to DECOMPRESS_QUEUE_SIZE blocks ahead of the reader,
+    so decompression overlaps with XML parsing (zlib, bz2 and lzma release the GIL while they work)
+    """
+    def __init__(self, filename_pepxml, compression):
+        self.blocks = queue.Queue(maxsize=DECOMPRESS_QUEUE_SIZE)
+        self.stopped = threading.Event()
+        self.buffer = b''
+        self.offset = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self.decompress, args=(filename_pepxml, compression), daemon=True)
+        self.thread.start()
+
+    def decompress(self, filename_pepxml, compression):
+        try:
+            with COMPRESSION_OPENERS[compression](filename_pepxml, 'rb') as f_in:
+                while( not self.stopped.is_set() ):
+                    block = f_in.read(DECOMPRESS_BLOCK_SIZE)
+                    self.put(block)
+                    if( not block ):
+                        break
+        except Exception as ex:
+            # Errors (e.g. a truncated file) are raised by read() in the parsing thread
+            self.put(ex)
+
+    def put(self, item):
+        while( not self.stopped.is_set() ):
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        if( size < 0 ):
+            return b''.join(iter(partial(self.read, DECOMPRESS_BLOCK_SIZE), b''))
+
+        if( self.offset >= len(self.buffer) and not self.eof ):
+            item = self.blocks.get()
+            if( isinstance(item, Exception) ):
+                self.eof = True
+                raise item
+            if( not item ):
+                self.eof = True
+            self.buffer = item
+            self.offset = 0
+
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.stopped.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_pepxml(filename_pepxml):
+    """
+    Open a .pepXML file for reading in binary mode
+
+    Files compressed with gzip, bz2 or xz (detected by their magic bytes) are decompressed
+    as a stream by a threaded_decompressor; no temporary files are created
+    """
+    compression = detect_compression(filename_pepxml)
+    if( compression is None ):
+        return open(filename_pepxml,'rb')
+    return threaded_decompressor(filename_pepxml, compression)
+
+def map_pepxml(filename_pepxml):
+    """
+    Return a read-only memory map of the file, or None if the file is empty (empty files cannot be mapped)
+
+    The mapping can be shared by several readers; slice it with memoryview to avoid copying bytes
+    """
+    with open(filename_pepxml,'rb') as f_in:
+        if( os.fstat(f_in.fileno()).st_size == 0 ):
+            return None
+        return mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+
+def iter_file_blocks(filename_pepxml, block_size, use_mmap=False):
+    """
+    Generator that yields the contents of the file in blocks of block_size bytes
+
+    If use_mmap is True, the blocks are memoryview slices of a memory map of the file, so no bytes are copied;
+    each block is released once the next one is requested, so callers must not keep a reference to it
+    Compressed files are decompressed as they are read (use_mmap is ignored for them)
+    """
+    if( not use_mmap or detect_compression(filename_pepxml) is not None ):
+        with open_pepxml(filename_pepxml) as f_in:
+            while True:
+                block = f_in.read(block_size)
+                if( not block ):
+                    break
+                yield block
+        return
+
+    mapping = map_pepxml(filename_pepxml)
+    if( mapping is None ):
+        return
+
+    try:
+        with memoryview(mapping) as view:
+            for offset in range(0, len(view), block_size):
+                with view[offset:offset + block_size] as block:
+                    yield block
+    finally:
+        mapping.close()
+
+SPECTRUM_QUERY_TAG = b'<spectrum_query '
+
+# Amount of data that count_spectrum_queries samples when it estimates the count
+COUNT_SAMPLE_SIZE = 4 * 1024 * 1024
+
+def count_spectrum_queries(filename_pepxml, exact=True):
+    """
+    Return a tuple of the number of spectrum_query elements in a .pepXML file and whether the number is exact
+
+    The elements are counted with a byte scan of the file, without parsing it
+    A compressed file is not decompressed in full; the count is estimated from the first COUNT_SAMPLE_SIZE bytes
+    of decompressed data and the fraction of the compressed file that was read to produce them
+    If exact is False, an uncompressed file is estimated the same way, from its first COUNT_SAMPLE_SIZE bytes
+    and the file size, so that a large file is not read an extra time before it is parsed
+    """
+    compression = detect_compression(filename_pepxml)
+    if( compression is None and exact ):
+        count = 0
+        overlap = b''
+        for block in iter_file_blocks(filename_pepxml, EXPAT_READ_BLOCK_SIZE):
+            # A tag can span two blocks, but the overlap is too short to hold a whole tag
+            count += (overlap + block).count(SPECTRUM_QUERY_TAG)
+            overlap = block[-(len(SPECTRUM_QUERY_TAG) - 1):]
+        return count, True
+
+    with open(filename_pepxml,'rb') as f_raw:
+        if( compression is None ):
+            f_in = f_raw
+        else:
+            f_in = COMPRESSION_OPENERS[compression](f_raw)
+
+        sample = f_in.read(COUNT_SAMPLE_SIZE)
+        count = sample.count(SPECTRUM_QUERY_TAG)
+        if( len(sample) < COUNT_SAMPLE_SIZE or not f_in.read(1) ):
+            return count, True
+        sampled_size = f_raw.tell()
+
+    return int(count * os.path.getsize(filename_pepxml) / sampled_size), False
+
+def iter_spectrum_queries_sax(filename_pepxml, use_mmap=False, options=None):
+    p = pepxml_stream_parser(options)
+    reader = xml.sax.make_parser()
+    reader.setContentHandler(p)
+
+    for block in iter_file_blocks(filename_pepxml, READ_BLOCK_SIZE, use_mmap):
+        reader.feed(block)
+        if( p.completed ):
+            yield from p.completed
+            p.completed = []
+
+    reader.close()
+    yield from p.completed
+    p.completed = []
+
+def iter_spectrum_queries_expat(filename_pepxml, use_mmap=False, options=None):
+    handler = pepxml_expat_handler(options)
+    parser = handler.create_parser()
+
+    for block in iter_file_blocks(filename_pepxml, EXPAT_READ_BLOCK_SIZE, use_mmap):
+        parser.Parse(block, False)
+        if( handler.completed ):
+            yield from handler.completed
+            handler.completed = []
+
+    parser.Parse(b'', True)
+    yield from handler.completed
+    handler.completed = []
+
+def iter_spectrum_queries_lxml(filename_pepxml, options=None):
+    if( options is None ):
+        options = parse_options()
+
+    with open_pepxml(filename_pepxml) as f_in:
+        # Only end events for spectrum_query are reported; the search hits are read from the completed element
+        context = etree.iterparse(f_in, events=('end',), tag='{*}spectrum_query', huge_tree=True)
+        parent = None
+        run_element = None
+        for event, element in context:
+            # The msms_run_summary is read when the first spectrum query in it (or in a new parent element) closes
+            if( element.getparent() is not parent ):
+                parent = element.getparent()
+                ancestor = next(element.iterancestors('{*}msms_run_summary'), None)
+                if( ancestor is not run_element ):
+                    run_element = ancestor
+                    options.run = None if ancestor is None else read_run_element(ancestor)
+
+            spectrum_id, spectrum_query = read_spectrum_query_element(element, options)
+            if( spectrum_query is not None ):
+                yield spectrum_id, spectrum_query
+
+            # Free the element, plus the header elements and spectrum queries that precede it
+            element.clear()
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+
+        del context
+
+def parse_spectrum_query_fragment(fragment, encoding=None, options=None, run=None):
+    """
+    Parse a string (or bytes) holding one or more complete spectrum_query elements with the pyexpat engine
+
+    The fragment is wrapped in msms_pipeline_analysis and msms_run_summary elements, as in a complete .pepXML file,
+    so that it has a single root element
+    Returns a list of (spectrum_id, spectrum_query) tuples
+
+    The spectrum queries are assigned to run (an msms_run, or None), since the wrapper has no attributes
+    """
+    handler = pepxml_expat_handler(options)
+    parser = handler.create_parser(encoding)
+    if( isinstance(fragment, str) ):
+        parser.Parse('<msms_pipeline_analysis><msms_run_summary>', False)
+        handler.options.run = run
+        parser.Parse(fragment, False)
+        parser.Parse('</msms_run_summary></msms_pipeline_analysis>', True)
+    else:
+        parser.Parse(b'<msms_pipeline_analysis><msms_run_summary>', False)
+        handler.options.run = run
+        parser.Parse(fragment, False)
+        parser.Parse(b'</msms_run_summary></msms_pipeline_analysis>', True)
+    return handler.completed
+
+def read_run_header(header, encoding=None):
+    """
+    Read the msms_run from the start of an msms_run_summary element: a string (or bytes) that begins with
+    the <msms_run_summary tag and includes its search_summary; the elements do not need to be closed
+
+    Returns None if header does not contain an msms_run_summary tag
+    """
+    handler = pepxml_expat_handler()
+    parser = handler.create_parser(encoding)
+    parser.Parse(header, False)
+    return handler.options.run
+
+def read_header_bytes(filename_pepxml, max_size=None):
+    """
+    Return the bytes of a .pepXML file before the first spectrum_query (the whole file if it has none);
+    reading stops once max_size bytes have been read, if max_size is not None
+
+    Compressed files are only decompressed as far as the first spectrum_query
+    """
+    compression = detect_compression(filename_pepxml)
+    with open(filename_pepxml,'rb') as f_raw:
+        if( compression is None ):
+            f_in = f_raw
+        else:
+            f_in = COMPRESSION_OPENERS[compression](f_raw)
+
+        header = b''
+        while( max_size is None or len(header) < max_size ):
+            block = f_in.read(READ_BLOCK_SIZE)
+            if( not block ):
+                break
+            # The tag can span two blocks
+            start = max(0, len(header) - len(SPECTRUM_QUERY_TAG) + 1)
+            header += block
+            end = header.find(SPECTRUM_QUERY_TAG, start)
+            if( end >= 0 ):
+                return header[:end]
+
+    return header
+
+# Headers read by read_header, keyed by absolute path: (file size, modification time, msms_run)
+loaded_headers = dict()
+
+def read_header(filename_pepxml):
+    """
+    Return the msms_run for the header of a .pepXML file: its first msms_run_summary, with the sample_enzyme and the
+    search_summary (search engine, database, enzymatic search constraint, the aminoacid_modification and
+    terminal_modification tables, and the parameter list; see msms_run.tolerances)
+
+    Only the start of the file, up to the first spectrum_query, is read, so the time does not depend on the file size
+    Returns None if the file has no msms_run_summary before the first spectrum_query
+
+    The result is cached by path, size and modification time, so reading the header of a file again is free
+    until the file changes; the cached msms_run is shared by every caller and should not be modified
+    """
+    key = os.path.abspath(filename_pepxml)
+    stat = os.stat(filename_pepxml)
+    cached = loaded_headers.get(key)
+    if( cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns ):
+        return cached[2]
+
+    header = read_header_bytes(filename_pepxml)
+    run = read_run_header(header, read_xml_encoding(header))
+    loaded_headers[key] = (stat.st_size, stat.st_mtime_ns, run)
+    return run
+
+## Fast path for .pepXML files created by PeptideListToXML (see WriteSpectrum in PepXMLWriter.cs)
+# PepXMLWriter writes one element per line, with a fixed attribute order,
+# so the fields can be read with regular expressions instead of an XML parser
+
+KNOWN_WRITER_HEADER_RE = re.compile(
+    rb'<\?xml version="1.0" encoding="(?:us-ascii|utf-8)"\?>\s*'
+    rb'<\?xml-stylesheet type="text/xsl" href="pepXML_std.xsl"\?>\s*'
+    rb'<msms_pipeline_analysis date="[^"]*" summary_xml="[^"]*" xmlns="http://regis-web.systemsbiology.net/pepXML" ')
+
+KNOWN_WRITER_PARAMETERS_RE = re.compile(rb'<!--(?:Dummy s|S)earch-engine parameters-->\s*<parameter ')
+
+KNOWN_WRITER_SPECTRUM_QUERY_RE = re.compile(
+    r'<spectrum_query spectrum="(?P<spectrum>[^"]*)" start_scan="(?P<start_scan>\d+)" end_scan="(?P<end_scan>\d+)"'
+    r' retention_time_sec="(?P<retention_time_sec>[^"]*)"(?: activation_method="(?P<activation_method>[^"]*)")?'
+    r' precursor_neutral_mass="(?P<precursor_neutral_mass>[^"]*)" assumed_charge="(?P<assumed_charge>\d+)"'
+    r' index="(?P<index>\d+)" spectrumNativeID="(?P<spectrumNativeID>[^"]*)">')
+
+KNOWN_WRITER_SEARCH_HIT_RE = re.compile(
+    r'<search_hit hit_rank="(?P<hit_rank>\d+)" peptide="(?P<peptide>[^"]*)"'
+    r' peptide_prev_aa="(?P<peptide_prev_aa>[^"]*)" peptide_next_aa="(?P<peptide_next_aa>[^"]*)"'
+    r'(?: peptide_with_mods="(?P<peptide_with_mods>[^"]*)")? protein="(?P<protein>[^"]*)"'
+    r' num_tot_proteins="(?P<num_tot_proteins>\d+)" num_matched_ions="(?P<num_matched_ions>\d+)"'
+    r' tot_num_ions="(?P<tot_num_ions>\d+)" calc_neutral_pep_mass="(?P<calc_neutral_pep_mass>[^"]*)"'
+    r' massdiff="(?P<massdiff>[^"]*)" num_tol_term="(?P<num_tol_term>\d+)"'
+    r' num_missed_cleavages="(?P<num_missed_cleavages>\d+)" is_rejected="(?P<is_rejected>\d+)">')
+
+KNOWN_WRITER_SEARCH_SCORE_RE = re.compile(r'<search_score name="([^"]*)" value="([^"]*)" />')
+
+KNOWN_WRITER_ALTERNATIVE_PROTEIN_RE = re.compile(r'<alternative_protein protein="([^"]*)"')
+
+# See WriteModificationInfo in PepXMLWriter.cs
+KNOWN_WRITER_MODIFICATION_INFO_RE = re.compile(r'<modification_info(?: mod_nterm_mass="(?P<mod_nterm_mass>[^"]*)")?(?: mod_cterm_mass="(?P<mod_cterm_mass>[^"]*)")? ?/?>')
+
+KNOWN_WRITER_MOD_AMINOACID_MASS_RE = re.compile(r'<mod_aminoacid_mass position="(\d+)" mass="([^"]*)" />')
+
+KNOWN_WRITER_READ_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Headers longer than this are not from PepXMLWriter
+KNOWN_WRITER_MAX_HEADER_SIZE = 1024 * 1024
+
+def is_known_writer_layout(filename_pepxml):
+    """
+    Return True if the header of the .pepXML file (everything before the first spectrum_query)
+    matches the layout written by PeptideListToXML
+    """
+    header = read_header_bytes(filename_pepxml, KNOWN_WRITER_MAX_HEADER_SIZE)
+    return KNOWN_WRITER_HEADER_RE.match(header) is not None and KNOWN_WRITER_PARAMETERS_RE.search(header) is not None
+
+def split_spectrum_query_records(text):
+    """
+    Generator that yields the text of each complete spectrum_query element in text
+    """
+    start = text.find('<spectrum_query ')
+    while( start >= 0 ):
+        end = text.find('</spectrum_query>', start)
+        if( end < 0 ):
+            break
+        end += len('</spectrum_query>')
+        yield text[start:end]
+        start = text.find('<spectrum_query ', end)
+
+def read_known_writer_record(record, options=None):
+    """
+    Read the text of one spectrum_query element written by PepXMLWriter
+
+    Returns a (spectrum_id, spectrum_query) tuple, or None if the element deviates from the expected layout;
+    spectrum_query is None if the spectrum query is rejected by the hit_filter of options
+    """
+    # Escaped characters, peptide prophet results, or unexpected elements are left to the XML parser
+    if( '&' in record or 'peptideprophet_result' in record ):
+        return None
+
+    match = KNOWN_WRITER_SPECTRUM_QUERY_RE.match(record)
+    if( match is None ):
+        return None
+
+    if( options is None ):
+        options = parse_options()
+    search_scores = options.search_scores
+    hit_filter = options.hit_filter
+
+    hit_matches = list(KNOWN_WRITER_SEARCH_HIT_RE.finditer(record, match.end()))
+    if( len(hit_matches) != record.count('<search_hit ') ):
+        return None
+
+    # Find the scores of every hit before anything is stored, so that a record that deviates
+    # from the expected layout does not update the statistics of hit_filter
+    hit_scores = []
+    hit_proteins = []
+    hit_modifications = []
+    modifications = options.modifications and '<modification_info' in record
+    for index, hit_match in enumerate(hit_matches):
+        if( index + 1 < len(hit_matches) ):
+            hit_end = hit_matches[index + 1].start()
+        else:
+            hit_end = len(record)
+        hit_scores.append(KNOWN_WRITER_SEARCH_SCORE_RE.findall(record, hit_match.end(), hit_end))
+        if( options.alternative_proteins ):
+            hit_proteins.append(KNOWN_WRITER_ALTERNATIVE_PROTEIN_RE.findall(record, hit_match.end(), hit_end))
+        else:
+            hit_proteins.append(())
+        if( modifications ):
+            hit_modifications.append((KNOWN_WRITER_MODIFICATION_INFO_RE.search(record, hit_match.end(), hit_end),
+                                      KNOWN_WRITER_MOD_AMINOACID_MASS_RE.findall(record, hit_match.end(), hit_end)))
+        else:
+            hit_modifications.append((None, ()))
+
+    if( sum(len(scores) for scores in hit_scores) != record.count('<search_score ') ):
+        return None
+    if( options.alternative_proteins and sum(len(proteins) for proteins in hit_proteins) != record.count('<alternative_protein ') ):
+        return None
+    if( modifications ):
+        if( sum(1 for modification_info, residues in hit_modifications if modification_info is not None) != record.count('<modification_info') ):
+            return None
+        if( sum(len(residues) for modification_info, residues in hit_modifications) != record.count('<mod_aminoacid_mass ') ):
+            return None
+
+    if( hit_filter is not None and not hit_filter.accept_spectrum_query(match) ):
+        return match['spectrum'], None
+
+    spectrum_query = read_spectrum_query(match, options)
+    search_hits = spectrum_query.search_hit
+
+    for hit_match, scores, proteins, (modification_info, residues) in zip(hit_matches, hit_scores, hit_proteins, hit_modifications):
+        if( hit_filter is not None and not hit_filter.accept_search_hit(hit_match) ):
+            continue
+
+        search_hit = read_search_hit(hit_match, options)
+        for protein in proteins:
+            add_alternative_protein(search_hit, protein, options)
+        if( modification_info is not None ):
+            read_modification_info(search_hit, modification_info.groupdict())
+        for position, mass in residues:
+            add_mod_aminoacid_mass(search_hit, position, mass)
+        for name, value in scores:
+            add_search_score(search_hit, name, value, search_scores)
+
+        if( hit_filter is None or hit_filter.accept_scores(search_hit) ):
+            search_hits.append(search_hit)
+
+    if( not options.end_spectrum_query(spectrum_query) ):
+        return match['spectrum'], None
+
+    return match['spectrum'], spectrum_query
+
+def read_known_writer_text(text, options=None):
+    """
+    Generator that yields (spectrum_id, spectrum_query) tuples for the spectrum_query elements in text
+
+    text can include the start of msms_run_summary elements; each replaces the run of options
+    """
+    if( options is None ):
+        options = parse_options()
+
+    segments = text.split('<msms_run_summary ')
+    for index, segment in enumerate(segments):
+        if( index > 0 ):
+            segment = '<msms_run_summary ' + segment
+            # The header ends at the first spectrum_query, or at the end of a run that has none
+            header = segment.split('<spectrum_query ', 1)[0].split('</msms_run_summary>', 1)[0]
+            options.run = read_run_header(header)
+
+        for record in split_spectrum_query_records(segment):
+            result = read_known_writer_record(record, options)
+            if( result is None ):
+                yield from parse_spectrum_query_fragment(record, options=options, run=options.run)
+            elif( result[1] is not None ):
+                yield result
+
+def iter_known_writer_text_blocks(filename_pepxml, use_mmap=False):
+    """
+    Generator that yields the file as decoded text blocks of about KNOWN_WRITER_READ_BLOCK_SIZE bytes,
+    each ending just after a </spectrum_query> tag (except for the last one)
+
+    If use_mmap is True, the blocks are decoded directly from a memory map of the file
+    """
+    if( not use_mmap or detect_compression(filename_pepxml) is not None ):
+        with open_pepxml(filename_pepxml) as f_in:
+            buffer = b''
+            while True:
+                block = f_in.read(KNOWN_WRITER_READ_BLOCK_SIZE)
+                buffer += block
+
+                # Return every complete spectrum_query in the buffer, keeping the remainder for the next block
+                if( block ):
+                    cut = buffer.rfind(b'</spectrum_query>')
+                    if( cut < 0 ):
+                        continue
+                    cut += len(b'</spectrum_query>')
+                else:
+                    cut = len(buffer)
+
+                yield buffer[:cut].decode('utf-8')
+                buffer = buffer[cut:]
+
+                if( not block ):
+                    break
+        return
+
+    mapping = map_pepxml(filename_pepxml)
+    if( mapping is None ):
+        return
+
+    try:
+        with memoryview(mapping) as view:
+            start = 0
+            while( start < len(mapping) ):
+                cut = mapping.rfind(b'</spectrum_query>', start, start + KNOWN_WRITER_READ_BLOCK_SIZE)
+                if( cut < 0 ):
+                    cut = mapping.find(b'</spectrum_query>', start)
+                if( cut < 0 ):
+                    cut = len(mapping)
+                else:
+                    cut += len(b'</spectrum_query>')
+
+                with view[start:cut] as block:
+                    text = str(block, 'utf-8')
+                yield text
+                start = cut
+    finally:
+        mapping.close()
+
+def iter_spectrum_queries_known_writer(filename_pepxml, use_mmap=False, options=None):
+    if( not is_known_writer_layout(filename_pepxml) ):
+        yield from iter_spectrum_queries_options(filename_pepxml, default_engine(), use_mmap, options)
+        return
+
+    for text in iter_known_writer_text_blocks(filename_pepxml, use_mmap):
+        yield from read_known_writer_text(text, options)
+
+def iter_spectrum_queries(filename_pepxml, engine=None, use_mmap=False, pool=None, fields=None, hit_filter=None, hits_per_spectrum=None, rank_by='hit_rank', rank_descending=None,
+                          msgfspecprob_mode=None, max_proteins=None):
+    """
+    Generator that yields (spectrum_id, spectrum_query) tuples, in file order,
+    as soon as each </spectrum_query> has been parsed
+
+    spectrum_query is the same spectrum_query_record that parse_by_filename stores in PSM[spectrum_id],
+    including the 'search_hit' list; only one block of the file is held in memory at a time
+
+    engine can be 'lxml', 'expat' or 'sax'; by default lxml is used if it is installed, otherwise expat
+    Use 'known_writer' for .pepXML files created by PeptideListToXML; it reads them with regular expressions,
+    and falls back to an XML engine if the file (or an individual spectrum query) has a different layout
+
+    If use_mmap is True, the expat, sax and known_writer engines read the file through a memory map
+
+    Peptide and protein names are interned in pool (a string_pool); if pool is None, a new pool is used for this file
+    fields limits the spectrum query and search hit fields that are read (see parse_options)
+    hit_filter is an optional psm_filter; only the spectrum queries and hits that it accepts are yielded,
+    and its statistics are complete once the generator is exhausted
+    hits_per_spectrum keeps only the best hits of each spectrum query, ranked by rank_by (see parse_by_filename)
+    msgfspecprob_mode is 'float' (the default), 'log10' or 'decimal' (see parse_options)
+    max_proteins limits the proteins kept for each search hit (see parse_options)
+    """
+    options = parse_options(fields, pool, hit_filter, hits_per_spectrum, rank_by, rank_descending, msgfspecprob_mode, max_proteins)
+    return iter_spectrum_queries_options(filename_pepxml, engine, use_mmap, options)
+
+def iter_spectrum_queries_options(filename_pepxml, engine, use_mmap, options):
+    engine = check_engine(engine)
+    if( engine == 'known_writer' ):
+        return iter_spectrum_queries_known_writer(filename_pepxml, use_mmap, options)
+    if( engine == 'lxml' ):
+        return iter_spectrum_queries_lxml(filename_pepxml, options)
+    if( engine == 'expat' ):
+        return iter_spectrum_queries_expat(filename_pepxml, use_mmap, options)
+    return iter_spectrum_queries_sax(filename_pepxml, use_mmap, options)
+
+def spectrum_query_run(item):
+    return item[1].run
+
+def iter_runs(filename_pepxml, engine=None, use_mmap=False, pool=None, fields=None, hit_filter=None, hits_per_spectrum=None, rank_by='hit_rank', rank_descending=None,
+              msgfspecprob_mode=None, max_proteins=None):
+    """
+    Generator that yields a (run, spectrum_queries) tuple for each msms_run_summary of a .pepXML file, in file order,
+    so that files merged by xinteract can be processed one run at a time
+
+    run is an msms_run, with the base_name, raw_data and search summary of the run;
+    spectrum_queries is an iterator over the (spectrum_id, spectrum_query) tuples of the run, streamed as in
+    iter_spectrum_queries (which takes the same arguments); as with itertools.groupby, it must be consumed
+    before the next run is requested
+    Runs whose spectrum queries are all rejected by hit_filter (or that have none) are not reported
+    """
+    spectrum_queries = iter_spectrum_queries(filename_pepxml, engine, use_mmap, pool, fields, hit_filter, hits_per_spectrum, rank_by, rank_descending,
+                                             msgfspecprob_mode, max_proteins)
+    return groupby(spectrum_queries, key=spectrum_query_run)
+
+def compare_psms(PSM, PSM_expected):
+    """
+    Return the IDs of the spectra that are missing from PSM, extra in PSM, or have different values
+    """
+    differences = [spectrum_id for spectrum_id in PSM_expected.keys() if PSM.get(spectrum_id) != PSM_expected[spectrum_id]]
+    differences.extend(spectrum_id for spectrum_id in PSM.keys() if spectrum_id not in PSM_expected)
+    return differences
+
+## Parallel parsing of a single file
+
+# Each worker process is given several byte ranges, which evens out the work
+PARALLEL_CHUNKS_PER_WORKER = 4
+
+XML_ENCODING_RE = re.compile(rb'<\?xml[^>]*encoding="([^"]+)"')
+
+def read_xml_encoding(header):
+    """
+    Return the encoding named in the XML declaration at the start of header (bytes), or None if not specified
+    """
+    match = XML_ENCODING_RE.match(header)
+    if( match is None ):
+        return None
+    return match.group(1).decode('ascii')
+
+def find_bytes(f_in, pattern, offset):
+    """
+    Return the file offset of the first occurrence of pattern at or after offset, or -1 if not found
+    """
+    f_in.seek(offset)
+    overlap = b''
+    while True:
+        block = f_in.read(READ_BLOCK_SIZE)
+        if( not block ):
+            return -1
+        data = overlap + block
+        index = data.find(pattern)
+        if( index >= 0 ):
+            return offset - len(overlap) + index
+        offset += len(block)
+        overlap = data[-(len(pattern) - 1):]
+
+def rfind_bytes(f_in, pattern, file_size):
+    """
+    Return the file offset of the last occurrence of pattern in the file, or -1 if not found
+    """
+    end = file_size
+    overlap = b''
+    while( end > 0 ):
+        start = max(0, end - READ_BLOCK_SIZE)
+        f_in.seek(start)
+        data = f_in.read(end - start) + overlap
+        index = data.rfind(pattern)
+        if( index >= 0 ):
+            return start + index
+        end = start
+        overlap = data[:len(pattern) - 1]
+    return -1
+
+def open_byte_search(filename_pepxml, use_mmap=False):
+    """
+    Open a .pepXML file for byte scans
+
+    Returns a tuple of the open file (or memory map), find(pattern, offset) and rfind(pattern, end),
+    which return the offset of the first occurrence at or after offset, or the last one that ends by end (-1 if none)
+    """
+    file_size = os.path.getsize(filename_pepxml)
+    if( use_mmap and file_size > 0 ):
+        # mmap.find and mmap.rfind scan the mapped pages in place
+        f_in = map_pepxml(filename_pepxml)
+        return f_in, f_in.find, lambda pattern, end: f_in.rfind(pattern, 0, end)
+
+    f_in = open(filename_pepxml,'rb')
+    return f_in, partial(find_bytes, f_in), partial(rfind_bytes, f_in)
+
+def split_spectrum_query_range(find, start, end, chunk_count):
+    """
+    Split the byte range from start (a <spectrum_query tag) to end into at most chunk_count ranges,
+    each starting at a <spectrum_query tag; find is a function from open_byte_search
+
+    Returns a list of (start, end) tuples
+    """
+    boundaries = [start]
+    chunk_size = (end - start) // max(chunk_count, 1)
+    for index in range(1, chunk_count):
+        boundary = find(b'<spectrum_query ', max(start + index * chunk_size, boundaries[-1] + 1))
+        if( boundary < 0 or boundary >= end ):
+            break
+        boundaries.append(boundary)
+    boundaries.append(end)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def find_spectrum_query_ranges(filename_pepxml, chunk_count, use_mmap=False):
+    """
+    Split the spectrum_query elements of a .pepXML file into at most chunk_count byte ranges,
+    using a byte scan for <spectrum_query tags
+
+    Each range starts at a <spectrum_query tag; the last one ends after the final </spectrum_query>
+    Returns a tuple of the header (the bytes before the first spectrum_query) and a list of (start, end) tuples
+    """
+    file_size = os.path.getsize(filename_pepxml)
+    f_in, find, rfind = open_byte_search(filename_pepxml, use_mmap)
+
+    with f_in:
+        first_start = find(b'<spectrum_query ', 0)
+        if( first_start < 0 ):
+            f_in.seek(0)
+            return f_in.read(), []
+
+        f_in.seek(0)
+        header = f_in.read(first_start)
+
+        last_end = rfind(b'</spectrum_query>', file_size) + len(b'</spectrum_query>')
+        ranges = split_spectrum_query_range(find, first_start, last_end, chunk_count)
+
+    return header, ranges
+
+def split_run_ranges(filename_pepxml, runs, chunk_count, use_mmap=False):
+    """
+    Split the spectrum queries of the runs found by find_run_ranges into about chunk_count byte ranges in total;
+    each run gets a share in proportion to its size (at least one range if it has spectrum queries),
+    so that no range crosses from one msms_run_summary into the next
+
+    Returns a list of (run index, start, end) tuples, in file order
+    """
+    total_size = sum(end - start for header, start, end in runs)
+    f_in, find, rfind = open_byte_search(filename_pepxml, use_mmap)
+
+    ranges = []
+    with f_in:
+        for run_index, (header, start, end) in enumerate(runs):
+            if( start == end ):
+                continue
+            run_chunk_count = max(1, round(chunk_count * (end - start) / total_size))
+            for range_start, range_end in split_spectrum_query_range(find, start, end, run_chunk_count):
+                ranges.append((run_index, range_start, range_end))
+
+    return ranges
+
+def parse_spectrum_query_range(filename_pepxml, start, end, encoding, known_writer, use_mmap=False, settings=None):
+    """
+    Worker function for parse_ranges_parallel; parses the spectrum queries in one byte range of the file
+    Returns a list of (spectrum_id, packed spectrum query) tuples, in file order, plus the statistics of hit_filter
+    (None if there is no filter); the spectrum queries are packed into tuples (see spectrum_query_record.pack),
+    which are much faster to pickle and unpickle than the records
+
+    If use_mmap is True, the range is parsed from a memoryview of a memory map of the file;
+    every worker maps the same file, so they share the page cache
+
+    Peptides and proteins are interned in a pool for the range, so that each is pickled only once
+    settings holds the keyword arguments of parse_options, other than pool
+    """
+    if( settings is None ):
+        settings = dict()
+    options = parse_options(**settings)
+
+    # hit_filter is a copy of the parent's filter; its counts are returned for the parent to add
+    hit_filter = options.hit_filter
+    if( hit_filter is not None ):
+        hit_filter.reset_statistics()
+
+    if( use_mmap ):
+        mapping = map_pepxml(filename_pepxml)
+        try:
+            with memoryview(mapping) as view, view[start:end] as data:
+                if( known_writer ):
+                    results = list(read_known_writer_text(str(data, 'utf-8'), options))
+                else:
+                    results = parse_spectrum_query_fragment(data, encoding, options)
+        finally:
+            mapping.close()
+    else:
+        with open(filename_pepxml,'rb') as f_in:
+            f_in.seek(start)
+            data = f_in.read(end - start)
+
+        if( known_writer ):
+            results = list(read_known_writer_text(data.decode('utf-8'), options))
+        else:
+            results = parse_spectrum_query_fragment(data, encoding, options)
+
+    results = [(spectrum_id, spectrum_query.pack()) for spectrum_id, spectrum_query in results]
+    if( hit_filter is None ):
+        return results, None
+    return results, hit_filter.statistics()
+
+def parse_ranges_parallel(filename_pepxml, ranges, workers, encoding, known_writer, use_mmap=False, pool=None, settings=None):
+    """
+    Parse byte ranges of a .pepXML file in a pool of worker processes (see parse_spectrum_query_range)
+
+    ranges is a list of (run, start, end) tuples, where run is the msms_run of the range (or None)
+    Yields (range index, spectrum_id, spectrum_query) tuples, in file order: the records are rebuilt from the packed
+    results of the workers, with the peptides and proteins interned in pool, and assigned to the run of their range
+    The filter statistics of the workers are added to settings['hit_filter']
+    """
+    if( pool is None ):
+        pool = string_pool()
+    if( settings is None ):
+        settings = dict()
+    hit_filter = settings.get('hit_filter')
+    if( not ranges ):
+        return
+
+    starts = [start for run, start, end in ranges]
+    ends = [end for run, start, end in ranges]
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+        range_results = executor.map(parse_spectrum_query_range, repeat(filename_pepxml), starts, ends, repeat(encoding), repeat(known_writer), repeat(use_mmap), repeat(settings))
+        for range_index, ((run, start, end), (results, statistics)) in enumerate(zip(ranges, range_results)):
+            if( statistics is not None ):
+                hit_filter.add_statistics(statistics)
+            for spectrum_id, packed in results:
+                spectrum_query = spectrum_query_record.unpack(packed)
+                spectrum_query.run = run
+                intern_search_hits(spectrum_query, pool)
+                yield range_index, spectrum_id, spectrum_query
+
+def read_run_headers(filename_pepxml, runs):
+    """
+    Read the encoding of a .pepXML file and the msms_run of each run found by find_run_ranges
+    Returns (encoding, list of msms_run)
+    """
+    with open(filename_pepxml,'rb') as f_in:
+        encoding = read_xml_encoding(f_in.read(READ_BLOCK_SIZE))
+    return encoding, [read_run_header(header, encoding) for header, start, end in runs]
+
+def parse_by_filename_parallel(filename_pepxml, workers, engine=None, use_mmap=False, pool=None, settings=None):
+    """
+    Parse a .pepXML file using a pool of worker processes
+
+    The header of each msms_run_summary is read once by the parent process, and the run's spectrum queries are split
+    into byte ranges that are parsed by the workers (with pyexpat, or the known_writer regular expressions when engine
+    is 'known_writer'); the results are merged in file order, with the peptides and proteins interned in pool,
+    and each spectrum query is given the msms_run of its range, as with the serial engines
+
+    settings holds the keyword arguments of parse_options, other than pool (see parse_spectrum_query_range)
+    """
+    known_writer = ( check_engine(engine) == 'known_writer' and is_known_writer_layout(filename_pepxml) )
+
+    chunk_count = workers * PARALLEL_CHUNKS_PER_WORKER
+    runs = find_run_ranges(filename_pepxml, use_mmap)
+    if( runs ):
+        encoding, run_headers = read_run_headers(filename_pepxml, runs)
+        ranges = [(run_headers[run_index], start, end) for run_index, start, end in split_run_ranges(filename_pepxml, runs, chunk_count, use_mmap)]
+    else:
+        # Spectrum queries without an msms_run_summary (not valid pepXML) are not assigned to a run
+        header, ranges = find_spectrum_query_ranges(filename_pepxml, chunk_count, use_mmap)
+        encoding = read_xml_encoding(header)
+        ranges = [(None, start, end) for start, end in ranges]
+
+    PSM = dict()
+    for range_index, spectrum_id, spectrum_query in parse_ranges_parallel(filename_pepxml, ranges, workers, encoding, known_writer, use_mmap, pool, settings):
+        merge_spectrum_query(PSM, spectrum_id, spectrum_query)
+    return PSM
+
+def find_run_ranges(filename_pepxml, use_mmap=False):
+    """
+    Find the msms_run_summary elements of a .pepXML file, using a byte scan for <msms_run_summary tags
+
+    Returns a list of (header, start, end) tuples, one per run: header is the bytes from the <msms_run_summary tag
+    to the first spectrum_query of the run; start and end are the byte range of its spectrum queries (equal if it has none)
+    """
+    file_size = os.path.getsize(filename_pepxml)
+    f_in, find, rfind = open_byte_search(filename_pepxml, use_mmap)
+
+    runs = []
+    with f_in:
+        run_start = find(b'<msms_run_summary ', 0)
+        while( run_start >= 0 ):
+            run_end = find(b'</msms_run_summary>', run_start)
+            if( run_end < 0 ):
+                run_end = file_size
+
+            start = find(b'<spectrum_query ', run_start)
+            if( start < 0 or start > run_end ):
+                start = run_end
+                end = run_end
+            else:
+                end = rfind(b'</spectrum_query>', run_end) + len(b'</spectrum_query>')
+
+            f_in.seek(run_start)
+            runs.append((f_in.read(start - run_start), start, end))
+            run_start = find(b'<msms_run_summary ', run_end)
+
+    return runs
+
+def parse_settings(fields=None, hit_filter=None, hits_per_spectrum=None, rank_by='hit_rank', rank_descending=None,
+                   msgfspecprob_mode=None, max_proteins=None, search_scores=None):
+    """
+    Return the keyword arguments of parse_options, other than pool, as a dictionary that can be sent to the worker processes
+
+    search_scores defaults to a copy of SEARCH_SCORES (including any registered scores) taken when the parse starts
+    """
+    if( search_scores is None ):
+        search_scores = dict(SEARCH_SCORES)
+    return {'fields': fields, 'hit_filter': hit_filter, 'hits_per_spectrum': hits_per_spectrum, 'rank_by': rank_by, 'rank_descending': rank_descending,
+            'msgfspecprob_mode': msgfspecprob_mode, 'max_proteins': max_proteins, 'search_scores': search_scores}
+
+def parse_runs(filename_pepxml, engine=None, workers=1, use_mmap=False, pool=None, fields=None, hit_filter=None,
+               hits_per_spectrum=None, rank_by='hit_rank', rank_descending=None, msgfspecprob_mode=None, max_proteins=None, search_scores=None):
+    """
+    Parse a .pepXML file into one partition per msms_run_summary
+
+    Returns a list of (run, PSM) tuples, in file order, where run is an msms_run and PSM is the dictionary
+    of the run's spectrum queries keyed by spectrum ID (see parse_by_filename, which takes the same arguments);
+    a spectrum ID that appears in two runs is kept in both
+    Runs whose spectrum queries are all rejected by hit_filter (or that have none) are not included
+
+    If workers is more than 1, the runs are parsed in parallel, one byte range per run
+    (compressed files are parsed serially); use parse_by_filename to split a single large run
+    """
+    engine = check_engine(engine)
+    settings = parse_settings(fields, hit_filter, hits_per_spectrum, rank_by, rank_descending, msgfspecprob_mode, max_proteins, search_scores)
+    options = parse_options(pool=pool, **settings)
+
+    runs = []
+    if( workers > 1 and detect_compression(filename_pepxml) is None ):
+        runs = find_run_ranges(filename_pepxml, use_mmap)
+
+    if( runs ):
+        known_writer = ( engine == 'known_writer' and is_known_writer_layout(filename_pepxml) )
+        encoding, run_headers = read_run_headers(filename_pepxml, runs)
+
+        # One range per run, so the range index is the index of the run's partition
+        partitions = [(run, dict()) for run in run_headers]
+        ranges = [(run, start, end) for run, (header, start, end) in zip(run_headers, runs)]
+        for run_index, spectrum_id, spectrum_query in parse_ranges_parallel(filename_pepxml, ranges, workers, encoding, known_writer, use_mmap, options.pool, settings):
+            merge_spectrum_query(partitions[run_index][1], spectrum_id, spectrum_query)
+
+        partitions = [(run, PSM) for run, PSM in partitions if PSM]
+    else:
+        partitions = []
+        for run, spectrum_queries in groupby(iter_spectrum_queries_options(filename_pepxml, engine, use_mmap, options), key=spectrum_query_run):
+            PSM = dict()
+            for spectrum_id, spectrum_query in spectrum_queries:
+                merge_spectrum_query(PSM, spectrum_id, spectrum_query)
+            partitions.append((run, PSM))
+
+    if( hit_filter is not None ):
+        print(hit_filter.report())
+
+    return partitions
+
+def parse_by_filename(filename_pepxml, engine=None, validate=False, workers=1, use_mmap=False, pool=None, fields=None, hit_filter=None,
+                      hits_per_spectrum=None, rank_by='hit_rank', rank_descending=None, msgfspecprob_mode=None, max_proteins=None, search_scores=None):
+    """
+    Parse a .pepXML file, returning a dictionary of spectrum queries keyed by spectrum ID
+
+    If workers is more than 1, the file is split into byte ranges that are parsed by a pool of processes
+    If use_mmap is True, the file is read through a memory map instead of file reads (see iter_spectrum_queries)
+    If validate is True, the file is parsed a second time using xml.sax,
+    and a ValueError is raised if the results differ
+
+    Files compressed with gzip, bz2 or xz are decompressed as they are parsed;
+    they cannot be split into byte ranges, so workers is ignored for them
+
+    Peptide and protein names are interned in pool (see string_pool); by default each file has its own pool
+
+    fields is a list of the keys to read, for example ['peptide', 'protein', 'expect']; see available_fields
+    Other attributes and search scores are skipped without being converted; by default every field is read
+
+    hit_filter is an optional psm_filter that rejects spectrum queries and search hits while the file is parsed;
+    its report is printed when parsing is complete
+
+    hits_per_spectrum keeps only the best N hits of each spectrum query, so memory grows with the number of spectra
+    rather than the number of hits; the hits are ranked by rank_by, any search hit key (by default hit_rank).
+    Smaller values are better for hit_rank, expect, msgfspecprob and the q-values, larger values for other scores;
+    set rank_descending to override this. Ties are won by the hit that comes first in the file
+
+    msgfspecprob values are floats by default; use msgfspecprob_mode='log10' or 'decimal' for other representations
+    (see parse_options)
+
+    The proteins of the alternative_protein elements of each search hit are stored in a list in
+    search_hit['alternative_protein'] (interned in pool, like the protein attribute);
+    max_proteins limits the number of proteins kept per hit, including the protein attribute
+
+    The modification_info of a search hit is stored in search_hit['mod_aminoacid_mass'], a list of (position, mass) tuples,
+    and search_hit['mod_nterm_mass'] and search_hit['mod_cterm_mass']; the keys are absent for unmodified peptides
+    (see modified_peptide)
+
+    search_scores is the table of search scores to read; by default, a copy of SEARCH_SCORES
+    (including any registered scores) is taken when the call starts and sent to the worker processes
+    """
+    engine = check_engine(engine)
+    compressed = detect_compression(filename_pepxml) is not None
+    settings = parse_settings(fields, hit_filter, hits_per_spectrum, rank_by, rank_descending, msgfspecprob_mode, max_proteins, search_scores)
+    options = parse_options(pool=pool, **settings)
+
+    if( workers > 1 and not compressed ):
+        PSM = parse_by_filename_parallel(filename_pepxml, workers, engine, use_mmap, options.pool, settings)
+    elif( engine == 'sax' and not use_mmap and not compressed ):
+        p = pepxml_parser(options)
+        xml.sax.parse(filename_pepxml,p)
+        PSM = p.PSM
+    else:
+        PSM = dict()
+        for spectrum_id, spectrum_query in iter_spectrum_queries_options(filename_pepxml, engine, use_mmap, options):
+            merge_spectrum_query(PSM, spectrum_id, spectrum_query)
+
+    if( hit_filter is not None ):
+        print(hit_filter.report())
+
+    if( validate ):
+        # The filter statistics of the second parse are kept separate
+        validation_filter = copy.copy(hit_filter)
+        if( validation_filter is not None ):
+            validation_filter.reset_statistics()
+
+        PSM_expected = dict()
+        validation_settings = dict(settings, hit_filter=validation_filter)
+        for spectrum_id, spectrum_query in iter_spectrum_queries_options(filename_pepxml, 'sax', False, parse_options(**validation_settings)):
+            merge_spectrum_query(PSM_expected, spectrum_id, spectrum_query)
+
+        differences = compare_psms(PSM, PSM_expected)
+        if( differences ):
+            raise ValueError("%i spectra parsed with the %s engine differ from xml.sax, including %s" % (len(differences), engine, differences[0]))
+
+    return PSM
+
+def parse_many(filenames_pepxml, workers=4, use_processes=False, engine=None, pool=None, fields=None):
+    """
+    Parse several .pepXML files with parse_by_filename, using a pool of worker threads
+    (or worker processes if use_processes is True)
+
+    If pool (a string_pool) is provided, it is shared by all of the files, so a peptide or protein
+    has the same object and the same code in every result
+    fields limits the fields that are read (see parse_by_filename)
+
+    Returns a list of PSM dictionaries, in the same order as filenames_pepxml
+    """
+    filenames_pepxml = list(filenames_pepxml)
+    if( workers <= 1 or len(filenames_pepxml) <= 1 ):
+        return [parse_by_filename(filename_pepxml, engine=engine, pool=pool, fields=fields) for filename_pepxml in filenames_pepxml]
+
+    if( not use_processes ):
+        with ThreadPoolExecutor(max_workers=min(workers, len(filenames_pepxml))) as executor:
+            return list(executor.map(partial(parse_by_filename, engine=engine, pool=pool, fields=fields), filenames_pepxml))
+
+    # A pool cannot be shared with other processes; the results are interned when they are returned
+    # The workers are given the scores registered in this process
+    with ProcessPoolExecutor(max_workers=min(workers, len(filenames_pepxml))) as executor:
+        results = list(executor.map(partial(parse_by_filename, engine=engine, fields=fields, search_scores=dict(SEARCH_SCORES)), filenames_pepxml))
+
+    if( pool is not None ):
+        for PSM in results:
+            for spectrum_query in PSM.values():
+                intern_search_hits(spectrum_query, pool)
+    return results
@@ -11,16 +11,69 @@ import os
 import sys
 import re
 
-# Import pepxml.py, which should be in the same directory as pepxml2hit_list.py
+# Import pepxml.py and psm_table.py, which should be in the same directory as pepxml2hit_list.py
 import pepxml
+import psm_table
 
-usage_mesg = 'Usage: pepxml2hit_list.py FileToProcess.pepXML'
+usage_mesg = ('Usage: pepxml2hit_list.py FileToProcess.pepXML [--proteins] [--mods]\n'
+              'Consecutive spectrum queries with the same spectrum ID are merged into one row; '
+              'if the spectrum ID appears again later in the file, it gets another row')
 
-if( len(sys.argv) != 2 ):
+# Fields read from the .pepXML file; other attributes and search scores are skipped while parsing
+HIT_LIST_FIELDS = [
+    'charge', 'neutral_mass', 'start_scan', 'end_scan', 'retention_time_sec',
+    'peptide', 'protein', 'missed_cleavages', 'Ions_Observed', 'Ions_Matched', 'NumTrypticEnds',
+    'xcorr', 'deltacn', 'deltacnstar', 'RankXc', 'XcRatio', 'Ions_Expected', 'msgfspecprob', 'expect']
+
+# msgfspecprob is read as a Decimal so that the MSGF_SpecProb column keeps the digits (and E notation) of the .pepXML file;
+# compare_msgfspecprob_modes.py reports whether float values would choose different best hits
+MSGFSPECPROB_MODE = 'decimal'
+
+# Columns of the hit list, with the format of each value
+HIT_LIST_COLUMNS = (
+    ('Spectrum_ID', '%s'), ('Charge', '%s'), ('NeutralMass', '%f'), ('Peptide', '%s'), ('Protein', '%s'),
+    ('MissedCleavages', '%d'), ('Xcorr', '%f'), ('DeltaCn', '%f'), ('DeltaCn2', '%f'), ('RankXc', '%s'), ('XcRatio', '%f'),
+    ('Ions_Observed', '%s'), ('Ions_Matched', '%s'), ('Ions_Expected', '%s'), ('NumTrypticEnds', '%s'),
+    ('MSGF_SpecProb', '%s'), ('EValue', '%s'), ('Scan_Scan', '%s'), ('End_Scan', '%s'), ('RetentionTime_Sec', '%f'))
+
+# With --proteins, an extra column lists the protein and alternative proteins of the best hit, separated by semicolons
+PROTEIN_LIST_COLUMN = ('Proteins', '%s')
+PROTEIN_SEPARATOR = ';'
+
+# With --mods, an extra column (after Proteins) has the peptide of the best hit with its modifications, for example PEPM[147.035]K
+MODIFIED_PEPTIDE_COLUMN = ('ModifiedPeptide', '%s')
+
+# Maximum number of proteins in the Proteins column (the default for /MaxProteins of PeptideListToXML)
+MAX_PROTEINS = 100
+
+# Spectrum queries are processed in batches: the best hits of a batch are chosen at once (see psm_table.batch_best_hits),
+# and its rows are formatted with the row format repeated, so that each batch is one % operation and one write
+ROWS_PER_BATCH = 4096
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+arguments = sys.argv[1:]
+include_protein_list = '--proteins' in arguments
+include_modified_peptide = '--mods' in arguments
+arguments = [argument for argument in arguments if argument not in ('--proteins', '--mods')]
+
+if( len(arguments) != 1 ):
     print(usage_mesg)
     sys.exit(1)
 
-filename_pepxml = sys.argv[1]
+hit_list_columns = HIT_LIST_COLUMNS
+hit_list_fields = HIT_LIST_FIELDS
+if( include_protein_list ):
+    hit_list_columns += (PROTEIN_LIST_COLUMN,)
+    hit_list_fields = hit_list_fields + [pepxml.ALTERNATIVE_PROTEIN_FIELD]
+if( include_modified_peptide ):
+    hit_list_columns += (MODIFIED_PEPTIDE_COLUMN,)
+    hit_list_fields = hit_list_fields + list(pepxml.MODIFICATION_FIELDS)
+
+row_format = '\t'.join(value_format for header, value_format in hit_list_columns) + '\n'
+batch_format = row_format * ROWS_PER_BATCH
+
+filename_pepxml = arguments[0]
 if( not os.access(filename_pepxml,os.R_OK) ):
     print("%s is not accessible."%filename_pepxml)
     print(usage_mesg)
@@ -28,101 +81,129 @@ if( not os.access(filename_pepxml,os.R_OK) ):
 
 print('Reading %s'%(filename_pepxml))
 
-PSM = pepxml.parse_by_filename(filename_pepxml)
-
-filename_out = filename_pepxml
+# The spectrum queries are read one at a time, and the rows are written one batch at a time,
+# so memory use does not grow with the size of the file
+def merge_duplicate_spectra(spectrum_queries):
+    """
+    Merge consecutive spectrum queries that have the same spectrum ID, like pepxml.merge_spectrum_query;
+    a spectrum ID that appears again after other spectra is yielded again (the spectrum IDs already written are not kept)
+    """
+    pending = None
+    for spectrum_id, spectrum_query in spectrum_queries:
+        if( pending is not None and pending[0] == spectrum_id ):
+            pepxml.merge_spectrum_query(dict([pending]), spectrum_id, spectrum_query)
+            continue
+
+        if( pending is not None ):
+            yield pending
+        pending = (spectrum_id, spectrum_query)
+
+    if( pending is not None ):
+        yield pending
+
+# The total for the progress messages is estimated from the start of the file, which is not read twice
+spectrum_count, count_is_exact = pepxml.count_spectrum_queries(filename_pepxml, exact=False)
+if( count_is_exact ):
+    progress_format = '%i / %i'
+else:
+    progress_format = '%i / ~%i'
+
+filename_out = pepxml.strip_compression_suffix(filename_pepxml)
 filename_out = re.sub('.pepxml$','',filename_out)
 filename_out += '.txt'
 
 print('Creating %s'%(filename_pepxml))
 sys.stderr.write("Write %s ... \n"%filename_out)
-f_out = open(filename_out,'w')
-
-f_out.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % ("Spectrum_ID", "Charge", "NeutralMass", "Peptide", "Protein", "MissedCleavages", "Xcorr", "DeltaCn"))
-f_out.write("\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % ("DeltaCn2", "RankXc", "XcRatio", "Ions_Observed", "Ions_Matched", "Ions_Expected", "NumTrypticEnds", "MSGF_SpecProb", "EValue"))
-f_out.write("\t%s\t%s\t%s\n" % ("Scan_Scan", "End_Scan", "RetentionTime_Sec"))
+f_out = open(filename_out,'w',buffering=OUTPUT_BUFFER_SIZE)
+
+f_out.write('\t'.join(header for header, value_format in hit_list_columns) + '\n')
+
+def write_batch(batch):
+    """
+    Choose the best hit of each spectrum query in batch, a list of (spectrum_id, spectrum_query) tuples,
+    and write their rows; returns the number of rows written (spectrum queries without hits are skipped)
+    """
+    batch_values = []
+    rows_written = 0
+    best_hits = psm_table.batch_best_hits([spectrum_query['search_hit'] for spectrum_id, spectrum_query in batch], MSGFSPECPROB_MODE)
+    for (spectrum_id, spectrum_query), best_hit in zip(batch, best_hits):
+        if( best_hit is None ):
+            continue
+
+        charge = spectrum_query['charge']
+        neutral_mass = spectrum_query['neutral_mass']
+
+        start_scan = spectrum_query['start_scan']
+        end_scan = spectrum_query['end_scan']
+        retention_time_sec = spectrum_query['retention_time_sec']
+
+        best_xcorr          = best_hit.get('xcorr',0)
+        best_peptide        = best_hit['peptide']
+        best_protein        = best_hit['protein']
+        best_deltacn        = best_hit.get('deltacn',0)
+        missed_cleavages    = best_hit['missed_cleavages']
+        best_deltacnStar    = best_hit.get('deltacnstar',0)
+        best_RankXc         = best_hit.get('RankXc',0)
+        best_XcRatio        = best_hit.get('XcRatio',0)
+        best_Ions_Observed  = best_hit.get('Ions_Observed',0)
+        best_Ions_Matched   = best_hit.get('Ions_Matched',0)
+        best_Ions_Expected  = best_hit.get('Ions_Expected',0)
+        best_NumTrypticEnds = best_hit.get('NumTrypticEnds',0)
+        best_msgfspecprob   = best_hit.get('msgfspecprob',1)
+        best_expect         = best_hit.get('expect',1)
+
+        batch_values.extend((spectrum_id, charge, neutral_mass, best_peptide, best_protein, missed_cleavages, best_xcorr, best_deltacn,
+                             best_deltacnStar, best_RankXc, best_XcRatio, best_Ions_Observed, best_Ions_Matched, best_Ions_Expected, best_NumTrypticEnds, best_msgfspecprob, best_expect,
+                             start_scan, end_scan, retention_time_sec))
+
+        if( include_protein_list ):
+            alternative_proteins = best_hit.get('alternative_protein')
+            if( alternative_proteins ):
+                batch_values.append(PROTEIN_SEPARATOR.join([best_protein] + alternative_proteins))
+            else:
+                batch_values.append(best_protein)
+
+        if( include_modified_peptide ):
+            batch_values.append(pepxml.modified_peptide(best_hit))
+
+        rows_written += 1
+
+    if( rows_written == ROWS_PER_BATCH ):
+        f_out.write(batch_format % tuple(batch_values))
+    elif( rows_written ):
+        f_out.write(row_format * rows_written % tuple(batch_values))
+    return rows_written
+
+def report_progress(lines_written, rows_written):
+    """
+    Print a progress message for each multiple of 10000 rows in a batch of rows_written rows,
+    written after lines_written rows
+    """
+    for line_count in range((lines_written // 10000 + 1) * 10000, lines_written + rows_written + 1, 10000):
+        print(progress_format % (line_count,spectrum_count))
 
 intLinesWritten = 0
-for spectrum_id in PSM.keys():
-    charge = PSM[spectrum_id]['charge']
-    neutral_mass = PSM[spectrum_id]['neutral_mass']
-
-    start_scan = PSM[spectrum_id]['start_scan']
-    end_scan = PSM[spectrum_id]['end_scan']
-    retention_time_sec = PSM[spectrum_id]['retention_time_sec']
-
-    best_peptide = ''
-    best_protein = ''
-    best_xcorr = 0
-    missed_cleavages = 0
-    best_deltacnStar = 0
-    best_RankXc = 0
-    best_XcRatio = 0
-    best_Ions_Observed = 0
-    best_Ions_Matched = 0
-    best_Ions_Expected = 0
-    best_NumTrypticEnds = 0
-    best_msgfspecprob = 1
-    best_expect = 1
-    StoreHit = 0
-    HitsParsed = 0
-        
-    for tmp_hit in PSM[spectrum_id]['search_hit']:
-        msgfspecprob = tmp_hit.setdefault('msgfspecprob',1)
-        expectScore = tmp_hit.setdefault('expect',1)
-        xcorr = tmp_hit.setdefault('xcorr',0)
-    
-        StoreHit = 0
-        if (HitsParsed == 0):
-            StoreHit = 1
-            best_msgfspecprob = msgfspecprob
-            best_expect = expectScore
-            best_xcorr = xcorr
-                 
-        elif (best_msgfspecprob < 1):
-            if (msgfspecprob < best_msgfspecprob):
-                StoreHit = 1
-        elif (best_expect < 1):
-            if (expectScore < best_expect):
-                StoreHit = 1
-        elif (best_xcorr > 0):
-            if (xcorr > best_xcorr):
-                StoreHit = 1
-
-        if( StoreHit == 1 ):
-            best_xcorr          = tmp_hit.setdefault('xcorr',0)
-            best_peptide        = tmp_hit['peptide']
-            best_protein        = tmp_hit['protein']
-            best_deltacn        = tmp_hit.setdefault('deltacn',0)
-            missed_cleavages    = tmp_hit['missed_cleavages']
-            best_deltacnStar    = tmp_hit.setdefault('deltacnstar',0)
-            best_RankXc         = tmp_hit.setdefault('RankXc',0)
-            best_XcRatio        = tmp_hit.setdefault('XcRatio',0)
-            best_Ions_Observed  = tmp_hit.setdefault('Ions_Observed',0)
-            best_Ions_Matched   = tmp_hit.setdefault('Ions_Matched',0)
-            best_Ions_Expected  = tmp_hit.setdefault('Ions_Expected',0)
-            best_NumTrypticEnds = tmp_hit.setdefault('NumTrypticEnds',0)
-            best_msgfspecprob   = tmp_hit.setdefault('msgfspecprob',1)
-            best_expect         = tmp_hit.setdefault('expect',1)
-       
-        HitsParsed += 1
-    # end for loop over spectrum hits
-    
-    if (HitsParsed > 0):
-        f_out.write("%s\t%s\t%f\t%s\t%s\t%d\t%f\t%f" % (spectrum_id, charge, neutral_mass, best_peptide, best_protein, missed_cleavages, best_xcorr, best_deltacn))
-
-        f_out.write("\t%f\t%s\t%f\t%s\t%s\t%s\t%s\t%s\t%s" % (best_deltacnStar, best_RankXc, best_XcRatio, best_Ions_Observed, best_Ions_Matched, best_Ions_Expected, best_NumTrypticEnds, best_msgfspecprob, best_expect))
-
-        f_out.write("\t%s\t%s\t%f\n" % (start_scan, end_scan, retention_time_sec))
-    
-        intLinesWritten += 1
-    
-        if (intLinesWritten % 10000 == 0):
-            print('%i / %i' % (intLinesWritten,len(PSM.keys())))
-    # end if
+batch = []
+spectrum_queries = pepxml.iter_spectrum_queries(filename_pepxml, pool=pepxml.unpooled_strings(), fields=hit_list_fields, msgfspecprob_mode=MSGFSPECPROB_MODE,
+                                                max_proteins=MAX_PROTEINS)
+for item in merge_duplicate_spectra(spectrum_queries):
+    batch.append(item)
+    if( len(batch) < ROWS_PER_BATCH ):
+        continue
+
+    rows_written = write_batch(batch)
+    batch.clear()
+
+    report_progress(intLinesWritten, rows_written)
+    intLinesWritten += rows_written
 
 # end for loop over PSMs
 
+if( batch ):
+    rows_written = write_batch(batch)
+    report_progress(intLinesWritten, rows_written)
+    intLinesWritten += rows_written
+
 f_out.close()
 
 print ("Done")
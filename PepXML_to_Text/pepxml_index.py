@@ -0,0 +1,215 @@
+#
+# Persistent spectrum offset index for .pepXML files
+#
+# The byte offset and length of every spectrum_query are stored in a binary sidecar file
+# (Dataset.pepXML.idx) so that individual spectra can be read without parsing the whole file
+#
+# The sidecar records the size and modification time of the .pepXML file;
+# if either changes, the index is rebuilt automatically
+#
+
+import os
+import re
+import struct
+from xml.sax.saxutils import unescape
+
+# Import pepxml.py, which should be in the same directory as pepxml_index.py
+import pepxml
+
+INDEX_MAGIC = b'PEPXIDX1'
+
+# Magic, .pepXML file size, .pepXML modification time (ns), record count, length of the spectrum ID prefix
+# The header is followed by the prefix shared by all spectrum IDs (typically the dataset name), then the records
+INDEX_HEADER = struct.Struct('<8sQqIH')
+
+# Offset, length, start_scan, charge, length of the spectrum ID suffix that follows the record
+INDEX_RECORD = struct.Struct('<QIiiH')
+
+SPECTRUM_QUERY_ATTRIBUTE_RE = re.compile(rb'\s(spectrum|start_scan|assumed_charge)="([^"]*)"')
+
+# Entities that can appear in a spectrum ID, in addition to &amp; &lt; and &gt;
+ATTRIBUTE_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+# Indexes loaded by this process, keyed by .pepXML path
+loaded_indexes = dict()
+
+class pepxml_index:
+    """
+    Location of each spectrum_query in a .pepXML file
+
+    records is a list of (spectrum_id, start_scan, charge, offset, length) tuples, in file order
+    """
+    def __init__(self, file_size, mtime_ns, records):
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.records = records
+        self.by_spectrum_id = dict()
+        self.by_scan = dict()
+
+        for record in records:
+            spectrum_id, start_scan, charge, offset, length = record
+            # A spectrum ID can appear in more than one spectrum_query; parse_by_filename merges them
+            self.by_spectrum_id.setdefault(spectrum_id, []).append(record)
+            self.by_scan.setdefault(start_scan, []).append(record)
+
+    def find(self, scan=None, charge=None, spectrum_id=None):
+        """
+        Return the records matching the spectrum ID, or the scan (and optionally charge)
+        """
+        if( spectrum_id is not None ):
+            return self.by_spectrum_id.get(spectrum_id, [])
+
+        records = self.by_scan.get(scan, [])
+        if( charge is not None ):
+            records = [record for record in records if record[2] == charge]
+        return records
+
+    def is_current(self, filename_pepxml):
+        """
+        Return True if the .pepXML file still has the size and modification time recorded in the index
+        """
+        stat = os.stat(filename_pepxml)
+        return stat.st_size == self.file_size and stat.st_mtime_ns == self.mtime_ns
+
+    def write(self, filename_index):
+        spectrum_ids = [record[0].encode('utf-8') for record in self.records]
+        # commonprefix returns a str for an empty list
+        prefix = os.path.commonprefix(spectrum_ids)[:0xFFFF] if spectrum_ids else b''
+
+        with open(filename_index,'wb') as f_out:
+            f_out.write(INDEX_HEADER.pack(INDEX_MAGIC, self.file_size, self.mtime_ns, len(self.records), len(prefix)))
+            f_out.write(prefix)
+            for spectrum_id_bytes, record in zip(spectrum_ids, self.records):
+                spectrum_id, start_scan, charge, offset, length = record
+                suffix = spectrum_id_bytes[len(prefix):]
+                f_out.write(INDEX_RECORD.pack(offset, length, start_scan, charge, len(suffix)))
+                f_out.write(suffix)
+
+    @classmethod
+    def read(cls, filename_index):
+        """
+        Load an index file; raises ValueError if it is not a valid index
+        """
+        with open(filename_index,'rb') as f_in:
+            data = f_in.read()
+
+        if( len(data) < INDEX_HEADER.size ):
+            raise ValueError("%s is not a pepXML index file" % filename_index)
+
+        magic, file_size, mtime_ns, record_count, prefix_length = INDEX_HEADER.unpack_from(data, 0)
+        if( magic != INDEX_MAGIC ):
+            raise ValueError("%s is not a pepXML index file" % filename_index)
+
+        records = []
+        position = INDEX_HEADER.size + prefix_length
+        prefix = data[INDEX_HEADER.size:position]
+        try:
+            for index in range(record_count):
+                offset, length, start_scan, charge, suffix_length = INDEX_RECORD.unpack_from(data, position)
+                position += INDEX_RECORD.size
+                spectrum_id = (prefix + data[position:position + suffix_length]).decode('utf-8')
+                position += suffix_length
+                records.append((spectrum_id, start_scan, charge, offset, length))
+        except struct.error:
+            raise ValueError("%s is truncated" % filename_index)
+
+        return cls(file_size, mtime_ns, records)
+
+def index_filename(filename_pepxml):
+    return filename_pepxml + '.idx'
+
+def read_spectrum_query_tag(tag):
+    """
+    Return the spectrum ID, start scan and charge from the start tag of a spectrum_query element (bytes)
+    """
+    attr = dict()
+    for name, value in SPECTRUM_QUERY_ATTRIBUTE_RE.findall(tag):
+        attr[name] = value
+
+    spectrum_id = unescape(attr[b'spectrum'].decode('utf-8'), ATTRIBUTE_ENTITIES)
+    return spectrum_id, int(attr[b'start_scan']), int(attr[b'assumed_charge'])
+
+def build_index(filename_pepxml, save=True):
+    """
+    Scan a .pepXML file for spectrum_query elements and return a pepxml_index
+
+    If save is True, the index is also written to Dataset.pepXML.idx (if the directory is writable)
+    """
+    if( pepxml.detect_compression(filename_pepxml) is not None ):
+        raise ValueError("Compressed files cannot be indexed: %s" % filename_pepxml)
+
+    stat = os.stat(filename_pepxml)
+    records = []
+
+    mapping = pepxml.map_pepxml(filename_pepxml)
+    if( mapping is not None ):
+        with mapping:
+            start = mapping.find(b'<spectrum_query ')
+            while( start >= 0 ):
+                tag_end = mapping.find(b'>', start)
+                end = mapping.find(b'</spectrum_query>', tag_end)
+                if( tag_end < 0 or end < 0 ):
+                    break
+                end += len(b'</spectrum_query>')
+
+                spectrum_id, start_scan, charge = read_spectrum_query_tag(mapping[start:tag_end])
+                records.append((spectrum_id, start_scan, charge, start, end - start))
+                start = mapping.find(b'<spectrum_query ', end)
+
+    index = pepxml_index(stat.st_size, stat.st_mtime_ns, records)
+
+    if( save ):
+        try:
+            index.write(index_filename(filename_pepxml))
+        except OSError as ex:
+            print("Unable to save the index for %s: %s" % (filename_pepxml, ex))
+
+    return index
+
+def load_index(filename_pepxml):
+    """
+    Return the pepxml_index for a .pepXML file, reading Dataset.pepXML.idx if it is up to date,
+    otherwise rebuilding it
+    """
+    key = os.path.abspath(filename_pepxml)
+    index = loaded_indexes.get(key)
+    if( index is not None and index.is_current(filename_pepxml) ):
+        return index
+
+    index = None
+    filename_index = index_filename(filename_pepxml)
+    if( os.path.exists(filename_index) ):
+        try:
+            index = pepxml_index.read(filename_index)
+        except ValueError:
+            index = None
+
+    if( index is None or not index.is_current(filename_pepxml) ):
+        index = build_index(filename_pepxml)
+
+    loaded_indexes[key] = index
+    return index
+
+def get_spectrum(filename_pepxml, scan=None, charge=None, spectrum_id=None):
+    """
+    Parse only the spectrum queries for the given scan (optionally limited to one charge),
+    or for the given spectrum ID, using the index to seek straight to them
+
+    Returns a list of (spectrum_id, spectrum_query) tuples, in file order; the list is empty if there is no match
+    """
+    if( scan is None and spectrum_id is None ):
+        raise ValueError("Either scan or spectrum_id must be provided")
+
+    index = load_index(filename_pepxml)
+    records = index.find(scan, charge, spectrum_id)
+    if( not records ):
+        return []
+
+    results = []
+    with open(filename_pepxml,'rb') as f_in:
+        encoding = pepxml.read_xml_encoding(f_in.read(pepxml.READ_BLOCK_SIZE))
+        for record_spectrum_id, start_scan, record_charge, offset, length in records:
+            f_in.seek(offset)
+            results.extend(pepxml.parse_spectrum_query_fragment(f_in.read(length), encoding))
+
+    return results
@@ -0,0 +1,625 @@
+#
+# Columnar storage for the spectrum queries and search hits in a .pepXML file
+#
+# Instead of a dictionary per spectrum query and per search hit, each field is stored in one
+# contiguous typed array (see the array module); peptides and proteins are dictionary-encoded
+# as int32 codes from a pepxml.string_pool
+#
+# The alternative proteins of the search hits are stored in compressed sparse row (CSR) form:
+# one array of protein codes for all hits, plus an array of offsets with the start of each hit's codes
+# Modified residues are stored as flat arrays of hit row, position and mass, with one entry per modified residue
+#
+# numpy is optional; when it is installed, column() returns numpy arrays that share memory with the table
+# and filtering and sorting are vectorized
+#
+
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+
+# Import pepxml.py, which should be in the same directory as psm_table.py
+import pepxml
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Spectrum query fields, with their array type codes (int32 or float64)
+SPECTRUM_COLUMNS = (
+    ('charge', 'i'),
+    ('start_scan', 'i'),
+    ('end_scan', 'i'),
+    ('neutral_mass', 'd'),
+    ('retention_time_sec', 'd'))
+
+# Search hit fields that are always present (see pepxml.read_search_hit)
+HIT_COLUMNS = (
+    ('hit_rank', 'i'),
+    ('missed_cleavages', 'i'),
+    ('NumTrypticEnds', 'i'),
+    ('Ions_Matched', 'i'),
+    ('Ions_Observed', 'i'),
+    ('num_tot_proteins', 'i'))
+
+# Dictionary-encoded search hit fields
+HIT_STRING_COLUMNS = ('peptide', 'protein')
+
+# Missing search scores are stored as NaN
+MISSING_SCORE = float('nan')
+
+# Fields that every table has
+TABLE_FIELDS = tuple(name for name, typecode in SPECTRUM_COLUMNS + HIT_COLUMNS) + HIT_STRING_COLUMNS
+
+def take(column, indices):
+    """
+    Return a new column with the values at the given row indices
+    """
+    if( isinstance(column, list) ):
+        return [column[index] for index in indices]
+
+    if( numpy is not None ):
+        result = array(column.typecode)
+        result.frombytes(numpy.frombuffer(column, dtype=column.typecode)[numpy.asarray(indices, dtype=numpy.intp)].tobytes())
+        return result
+
+    return array(column.typecode, map(column.__getitem__, indices))
+
+def select_best_rows(hit_group, values, msgfspecprob_limit, exact_ties, cascade_rows):
+    """
+    Find the best hit of each group of hits with one numpy lexsort, as chosen by pepxml.cascade_best_hit
+
+    hit_group is the group number of each hit row; values are float64 arrays of the msgfspecprob, expect and xcorr
+    of each hit (see pepxml.best_hit_scores). If exact_ties is True, the msgfspecprob values were Decimals,
+    and groups whose best values are tied after rounding to float are re-checked
+    cascade_rows(rows) is called with the hit rows of each group that the sort cannot decide exactly,
+    and returns the best of those rows
+
+    Returns numpy arrays of the groups that have hits, in increasing order, and the best hit row of each
+    """
+    # The cascade level of each hit is the first score that passes its test (3 if none do);
+    # within a group whose hits all have the same level, the cascade keeps the first hit with the best value of that score
+    tests = [values[0] < msgfspecprob_limit, values[1] < 1, values[2] > 0]
+    level = numpy.select(tests, [0, 1, 2], 3)
+    key = numpy.select(tests, [values[0], values[1], -values[2]], 0.0)
+
+    # Group the hits, keeping file order within each group, then sort each group by key (ties stay in file order)
+    order = numpy.argsort(hit_group, kind='stable')
+    group = hit_group[order]
+    key = key[order]
+    level = level[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], group[1:] != group[:-1])))
+    sizes = numpy.diff(numpy.append(starts, len(order)))
+
+    best = numpy.lexsort((numpy.arange(len(order)), key, group))[starts]
+    best_rows = order[best]
+
+    # Groups with mixed levels switch scores part way through the cascade;
+    # Decimal msgfspecprob values (msgfspecprob_mode 'decimal') that round to the same float may not be a real tie
+    undecided = numpy.minimum.reduceat(level, starts) != numpy.maximum.reduceat(level, starts)
+    if( exact_ties ):
+        ties = numpy.add.reduceat(key == numpy.repeat(key[best], sizes), starts) > 1
+        undecided |= ( ties & (level[best] == 0) )
+
+    for index in numpy.flatnonzero(undecided):
+        best_rows[index] = cascade_rows(order[starts[index]:starts[index] + sizes[index]].tolist())
+
+    return group[starts], best_rows
+
+def batch_best_hits(search_hit_lists, msgfspecprob_mode=None):
+    """
+    Return the best hit of each list of search hits (None for an empty list), as chosen by pepxml.best_hit
+
+    With numpy installed, the whole batch is decided at once by select_best_rows;
+    pepxml2hit_list.py calls this once per batch of spectrum queries, so the hits of the batch are the only ones held
+    msgfspecprob_mode is the mode the hits were read with (see pepxml.parse_options)
+    """
+    if( numpy is None ):
+        return [pepxml.best_hit(search_hits, msgfspecprob_mode) for search_hits in search_hit_lists]
+
+    best_hits = [None] * len(search_hit_lists)
+    search_hits = [search_hit for search_hit_list in search_hit_lists for search_hit in search_hit_list]
+    if( not search_hits ):
+        return best_hits
+
+    scores = pepxml.best_hit_scores(msgfspecprob_mode)
+    hit_group = numpy.repeat(numpy.arange(len(search_hit_lists)), [len(search_hit_list) for search_hit_list in search_hit_lists])
+    values = [numpy.array([search_hit.get(name, default) for search_hit in search_hits], dtype=numpy.float64) for name, default in scores]
+
+    def cascade_rows(rows):
+        cascade_values = [tuple(search_hits[row].get(name, default) for name, default in scores) for row in rows]
+        return rows[pepxml.cascade_best_hit(cascade_values, scores[0][1])]
+
+    groups, best_rows = select_best_rows(hit_group, values, scores[0][1], msgfspecprob_mode == 'decimal', cascade_rows)
+    for group, row in zip(groups.tolist(), best_rows.tolist()):
+        best_hits[group] = search_hits[row]
+    return best_hits
+
+class PSMTable:
+    """
+    Spectrum queries and search hits stored column by column
+
+    Spectrum rows are in file order; hit rows are in file order, and hit_columns['spectrum_index']
+    gives the spectrum row of each hit
+
+    Search scores are stored in score_columns, one float64 column per score (NaN if a hit does not have the score);
+    scores whose converter does not return a number (such as msgfspecprob read as a Decimal) are stored in a list
+
+    The alternative proteins of hit row i are the codes protein_codes[protein_offsets[i]:protein_offsets[i + 1]]
+    (see alternative_proteins); hits without alternative proteins only add an offset
+
+    Each mod_aminoacid_mass element is a row of mod_hit_index, mod_position and mod_mass, sorted by hit row;
+    unmodified hits add nothing. The terminal modification masses are stored as the score columns
+    mod_nterm_mass and mod_cterm_mass, which only exist if a hit has them (see modified_peptides)
+
+    Use as_dict() for the {spectrum_id: spectrum_query} dictionary returned by pepxml.parse_by_filename
+    """
+    def __init__(self, pool=None, run=None):
+        # The pepxml.msms_run of the table, for the per-run tables from parse_to_tables
+        self.run = run
+        self.spectrum_ids = []
+        self.spectrum_columns = {name: array(typecode) for name, typecode in SPECTRUM_COLUMNS}
+        self.hit_columns = {name: array(typecode) for name, typecode in HIT_COLUMNS}
+        self.hit_columns['spectrum_index'] = array('i')
+        for name in HIT_STRING_COLUMNS:
+            self.hit_columns[name] = array('i')
+        self.protein_offsets = array('i', [0])
+        self.protein_codes = array('i')
+        self.mod_hit_index = array('i')
+        self.mod_position = array('i')
+        self.mod_mass = array('d')
+
+        # Peptides and proteins; the hit columns hold their codes in this pool, which can be shared by several tables
+        if( pool is None ):
+            pool = pepxml.string_pool()
+        self.pool = pool
+
+        self.score_columns = dict()
+        # Names of the score columns whose values were ints before they were stored as float64
+        self.int_scores = set()
+
+    def __len__(self):
+        return len(self.spectrum_ids)
+
+    @property
+    def hit_count(self):
+        return len(self.hit_columns['spectrum_index'])
+
+    def add_score_column(self, name, value, row_count):
+        # Earlier hits do not have this score
+        if( isinstance(value, (int, float)) ):
+            if( isinstance(value, int) ):
+                self.int_scores.add(name)
+            column = array('d', [MISSING_SCORE]) * row_count
+        else:
+            column = [None] * row_count
+        self.score_columns[name] = column
+        return column
+
+    def append_score(self, name, value, row):
+        column = self.score_columns.get(name)
+        if( column is None ):
+            column = self.add_score_column(name, value, row)
+
+        if( isinstance(column, array) and not isinstance(value, (int, float)) ):
+            # The converter returned something other than a number; keep the column as a list from now on
+            column = [None if stored != stored else stored for stored in column]
+            self.score_columns[name] = column
+
+        column.append(value)
+
+    def append(self, spectrum_id, spectrum_query):
+        """
+        Add a spectrum query (a pepxml.spectrum_query_record, or a dictionary with the same keys), including its search hits
+        """
+        spectrum_index = len(self.spectrum_ids)
+        self.spectrum_ids.append(spectrum_id)
+        for name, typecode in SPECTRUM_COLUMNS:
+            self.spectrum_columns[name].append(spectrum_query[name])
+
+        hit_columns = self.hit_columns
+        spectrum_index_column = hit_columns['spectrum_index']
+        for search_hit in spectrum_query['search_hit']:
+            row = len(spectrum_index_column)
+            spectrum_index_column.append(spectrum_index)
+
+            values = dict(search_hit.items())
+            for name, typecode in HIT_COLUMNS:
+                hit_columns[name].append(values.pop(name))
+            for name in HIT_STRING_COLUMNS:
+                hit_columns[name].append(self.pool.code(values.pop(name)))
+
+            alternative_proteins = values.pop(pepxml.ALTERNATIVE_PROTEIN_FIELD, None)
+            if( alternative_proteins ):
+                self.protein_codes.extend(map(self.pool.code, alternative_proteins))
+            self.protein_offsets.append(len(self.protein_codes))
+
+            modified_residues = values.pop('mod_aminoacid_mass', None)
+            if( modified_residues ):
+                for position, mass in modified_residues:
+                    self.mod_hit_index.append(row)
+                    self.mod_position.append(position)
+                    self.mod_mass.append(mass)
+
+            for name, value in values.items():
+                self.append_score(name, value, row)
+
+            # Pad the scores this hit does not have
+            for column in self.score_columns.values():
+                if( len(column) == row ):
+                    if( isinstance(column, array) ):
+                        column.append(MISSING_SCORE)
+                    else:
+                        column.append(None)
+
+    def score_values(self, name, default):
+        """
+        Return a list with the value of a score for each hit, using default where a hit does not have the score
+        """
+        column = self.score_columns.get(name)
+        if( column is None ):
+            return [default] * self.hit_count
+        if( name in self.int_scores ):
+            return [default if value != value else int(value) for value in column]
+        return [default if value is None or value != value else value for value in column]
+
+    def float_score_column(self, name, default):
+        """
+        Return a score as a float64 numpy array, using default where a hit does not have the score
+        """
+        column = self.score_columns.get(name)
+        if( column is None ):
+            return numpy.full(self.hit_count, float(default))
+        values = numpy.array(column, dtype=numpy.float64)
+        values[numpy.isnan(values)] = default
+        return values
+
+    def spectrum_groups(self):
+        """
+        Return the group number of each spectrum row and the spectrum rows of each group
+
+        A group is a spectrum ID; groups are numbered in order of first appearance,
+        so rows with a duplicate spectrum ID are merged as in pepxml.merge_spectrum_query
+        """
+        group_numbers = dict()
+        group_of_row = array('i')
+        group_rows = []
+        for row, spectrum_id in enumerate(self.spectrum_ids):
+            group = group_numbers.get(spectrum_id)
+            if( group is None ):
+                group = group_numbers[spectrum_id] = len(group_rows)
+                group_rows.append([])
+            else:
+                print("Duplicate PSM : %s"%spectrum_id)
+            group_of_row.append(group)
+            group_rows[group].append(row)
+        return group_of_row, group_rows
+
+    def best_hits(self, msgfspecprob_mode=None):
+        """
+        Return the best hit of each spectrum ID, as chosen by pepxml2hit_list.py (see pepxml.cascade_best_hit),
+        as a list of (spectrum_id, spectrum_row, hit_row) tuples in order of first appearance of the spectrum ID
+
+        spectrum_row is the last row with the spectrum ID, whose values pepxml.merge_spectrum_query keeps;
+        spectrum IDs without hits are skipped
+
+        With numpy installed, the hits are grouped by spectrum and the best hit of each group is found with one lexsort;
+        groups that the sort cannot decide exactly like the cascade are passed to pepxml.cascade_best_hit
+
+        msgfspecprob_mode is the mode the table was read with (see pepxml.parse_options)
+        """
+        scores = pepxml.best_hit_scores(msgfspecprob_mode)
+        group_of_row, group_rows = self.spectrum_groups()
+        if( numpy is None ):
+            best_rows = self.best_hit_rows_python(group_of_row, scores)
+        else:
+            best_rows = self.best_hit_rows_numpy(group_of_row, scores)
+
+        return [(self.spectrum_ids[group_rows[group][0]], group_rows[group][-1], hit_row) for group, hit_row in best_rows]
+
+    def cascade_scores(self, scores):
+        """
+        Return the values of scores (see pepxml.best_hit_scores) for each hit, as a list of tuples
+        """
+        return list(zip(*[self.score_values(name, default) for name, default in scores]))
+
+    def best_hit_rows_python(self, group_of_row, scores):
+        hit_rows = dict()
+        for hit_row, spectrum_row in enumerate(self.hit_columns['spectrum_index']):
+            hit_rows.setdefault(group_of_row[spectrum_row], []).append(hit_row)
+
+        values = self.cascade_scores(scores)
+        msgfspecprob_limit = scores[0][1]
+        best_rows = []
+        for group in sorted(hit_rows):
+            rows = hit_rows[group]
+            best_rows.append((group, rows[pepxml.cascade_best_hit([values[row] for row in rows], msgfspecprob_limit)]))
+        return best_rows
+
+    def best_hit_rows_numpy(self, group_of_row, scores):
+        if( self.hit_count == 0 ):
+            return []
+
+        hit_group = numpy.frombuffer(group_of_row, dtype='i')[numpy.frombuffer(self.hit_columns['spectrum_index'], dtype='i')]
+        values = [self.float_score_column(name, default) for name, default in scores]
+        exact_ties = isinstance(self.score_columns.get('msgfspecprob'), list)
+
+        cascade_values = []
+        def cascade_rows(rows):
+            if( not cascade_values ):
+                cascade_values.extend(self.cascade_scores(scores))
+            return rows[pepxml.cascade_best_hit([cascade_values[row] for row in rows], scores[0][1])]
+
+        groups, best_rows = select_best_rows(hit_group, values, scores[0][1], exact_ties, cascade_rows)
+        return list(zip(groups.tolist(), best_rows.tolist()))
+
+    def column(self, name):
+        """
+        Return a spectrum, hit or score column; string columns are returned as codes (see decode)
+
+        If numpy is installed, typed columns are returned as numpy arrays that share memory with the table;
+        the table cannot be appended to while such an array is in use (array raises BufferError)
+        """
+        for columns in (self.hit_columns, self.score_columns, self.spectrum_columns):
+            column = columns.get(name)
+            if( column is not None ):
+                break
+        else:
+            raise KeyError(name)
+
+        if( numpy is not None and isinstance(column, array) ):
+            return numpy.frombuffer(column, dtype=column.typecode)
+        return column
+
+    def alternative_proteins(self, row):
+        """
+        Return the list of alternative proteins of a hit row (empty if it has none)
+        """
+        return self.pool.decode(self.protein_codes[self.protein_offsets[row]:self.protein_offsets[row + 1]])
+
+    def modified_residues(self, row):
+        """
+        Return the list of (position, mass) tuples of the modified residues of a hit row (empty if it has none)
+        """
+        start = bisect_left(self.mod_hit_index, row)
+        end = bisect_left(self.mod_hit_index, row + 1, start)
+        return list(zip(self.mod_position[start:end], self.mod_mass[start:end]))
+
+    def modified_peptides(self, mass_format=pepxml.MODIFIED_MASS_FORMAT):
+        """
+        Return a list with the peptide of each hit row, including its modifications (see pepxml.format_modified_peptide)
+
+        Only the modified hits are formatted, and the masses are formatted in one pass (vectorized with numpy);
+        unmodified hits share the peptide strings of the pool, so a file without modifications costs one decode
+        """
+        peptide_codes = self.hit_columns['peptide']
+        peptides = self.decode(peptide_codes)
+
+        terminal_labels = []
+        for name in ('mod_nterm_mass', 'mod_cterm_mass'):
+            labels = dict()
+            column = self.score_columns.get(name)
+            if( column is not None ):
+                for row, mass in enumerate(self.score_values(name, None)):
+                    if( mass is not None ):
+                        labels[row] = mass_format % mass
+            terminal_labels.append(labels)
+        nterm_labels, cterm_labels = terminal_labels
+
+        if( not self.mod_hit_index and not nterm_labels and not cterm_labels ):
+            return peptides
+
+        if( numpy is not None ):
+            mass_labels = numpy.char.mod(mass_format, numpy.frombuffer(self.mod_mass, dtype='d')).tolist()
+        else:
+            mass_labels = [mass_format % mass for mass in self.mod_mass]
+
+        residue_labels = dict()
+        for row, position, label in zip(self.mod_hit_index, self.mod_position, mass_labels):
+            residue_labels.setdefault(row, []).append((position, label))
+
+        # The same modified peptide is usually found by many hits
+        formatted = dict()
+        for row in set(residue_labels).union(nterm_labels, cterm_labels):
+            labels = residue_labels.get(row)
+            key = (peptide_codes[row], None if labels is None else tuple(labels), nterm_labels.get(row), cterm_labels.get(row))
+            peptide = formatted.get(key)
+            if( peptide is None ):
+                peptide = pepxml.insert_modification_labels(peptides[row], labels, key[2], key[3])
+                formatted[key] = peptide
+            peptides[row] = peptide
+
+        return peptides
+
+    def decode(self, codes):
+        """
+        Convert peptide or protein codes back to strings
+        """
+        return self.pool.decode(codes)
+
+    def hit_spectrum_column(self, name):
+        """
+        Return a spectrum column (such as charge) repeated for each hit row
+        """
+        return take(self.spectrum_columns[name], self.hit_columns['spectrum_index'])
+
+    def take_hits(self, indices):
+        """
+        Return a new PSMTable with the given hit rows, in the given order,
+        plus the spectrum queries they belong to (spectrum queries without a selected hit are dropped)
+        """
+        indices = list(indices)
+        spectrum_index = self.hit_columns['spectrum_index']
+        spectrum_rows = sorted(set(take(spectrum_index, indices)))
+        new_index = {old: new for new, old in enumerate(spectrum_rows)}
+
+        table = PSMTable(self.pool)
+        table.int_scores = set(self.int_scores)
+
+        table.spectrum_ids = [self.spectrum_ids[row] for row in spectrum_rows]
+        for name, column in self.spectrum_columns.items():
+            table.spectrum_columns[name] = take(column, spectrum_rows)
+
+        for name, column in self.hit_columns.items():
+            table.hit_columns[name] = take(column, indices)
+        table.hit_columns['spectrum_index'] = array('i', [new_index[row] for row in table.hit_columns['spectrum_index']])
+
+        offsets = self.protein_offsets
+        for index in indices:
+            table.protein_codes.extend(self.protein_codes[offsets[index]:offsets[index + 1]])
+            table.protein_offsets.append(len(table.protein_codes))
+
+        if( self.mod_hit_index ):
+            mod_rows = dict()
+            for mod_row, row in enumerate(self.mod_hit_index):
+                mod_rows.setdefault(row, []).append(mod_row)
+            for new_row, index in enumerate(indices):
+                for mod_row in mod_rows.get(index, ()):
+                    table.mod_hit_index.append(new_row)
+                    table.mod_position.append(self.mod_position[mod_row])
+                    table.mod_mass.append(self.mod_mass[mod_row])
+
+        for name, column in self.score_columns.items():
+            table.score_columns[name] = take(column, indices)
+
+        return table
+
+    def filter_hits(self, mask):
+        """
+        Return a new PSMTable with the hits where mask (a sequence of booleans, one per hit) is true
+
+        For example, with numpy installed:
+            table.filter_hits((table.column('hit_rank') == 1) & (table.column('expect') < 1E-10))
+        """
+        if( numpy is not None ):
+            return self.take_hits(numpy.flatnonzero(numpy.asarray(mask, dtype=bool)))
+        return self.take_hits(index for index, selected in enumerate(mask) if selected)
+
+    def sort_hits(self, name, descending=False):
+        """
+        Return a new PSMTable with the hits sorted by a hit or score column (stable, so ties keep file order)
+
+        Missing scores sort last
+        """
+        values = self.column(name)
+        if( numpy is not None and isinstance(values, numpy.ndarray) ):
+            keys = -values if descending else values
+            return self.take_hits(numpy.argsort(keys, kind='stable'))
+
+        def sort_key(index):
+            value = values[index]
+            if( value is None or value != value ):
+                return (1, 0)
+            return (0, -value if descending else value)
+
+        return self.take_hits(sorted(range(self.hit_count), key=sort_key))
+
+    def search_hit(self, row):
+        """
+        Return the search hit dictionary for a hit row, matching what pepxml.read_search_hit and add_search_score create
+        """
+        search_hit = dict()
+        for name, typecode in HIT_COLUMNS:
+            search_hit[name] = self.hit_columns[name][row]
+        for name in HIT_STRING_COLUMNS:
+            search_hit[name] = self.pool.values[self.hit_columns[name][row]]
+
+        if( self.protein_offsets[row + 1] > self.protein_offsets[row] ):
+            search_hit[pepxml.ALTERNATIVE_PROTEIN_FIELD] = self.alternative_proteins(row)
+
+        modified_residues = self.modified_residues(row)
+        if( modified_residues ):
+            search_hit['mod_aminoacid_mass'] = modified_residues
+
+        for name, column in self.score_columns.items():
+            value = column[row]
+            if( value is None or value != value ):
+                continue
+            if( name in self.int_scores ):
+                value = int(value)
+            search_hit[name] = value
+
+        return search_hit
+
+    def spectrum_query(self, row, hit_rows):
+        spectrum_query = {name: self.spectrum_columns[name][row] for name, typecode in SPECTRUM_COLUMNS}
+        spectrum_query['search_hit'] = [self.search_hit(hit_row) for hit_row in hit_rows]
+        return spectrum_query
+
+    def as_dict(self):
+        """
+        Return a read-only {spectrum_id: spectrum_query} mapping, equivalent to pepxml.parse_by_filename;
+        the dictionaries are created when a spectrum is accessed
+        """
+        return psm_table_view(self)
+
+class psm_table_view(Mapping):
+    """
+    Dictionary view of a PSMTable; duplicate spectrum IDs are merged as in pepxml.merge_spectrum_query
+    """
+    def __init__(self, table):
+        self.table = table
+        self.spectrum_rows = dict()
+        for row, spectrum_id in enumerate(table.spectrum_ids):
+            self.spectrum_rows.setdefault(spectrum_id, []).append(row)
+
+        self.hit_rows = [[] for row in range(len(table.spectrum_ids))]
+        for hit_row, row in enumerate(table.hit_columns['spectrum_index']):
+            self.hit_rows[row].append(hit_row)
+
+    def __getitem__(self, spectrum_id):
+        rows = self.spectrum_rows[spectrum_id]
+        hit_rows = [hit_row for row in rows for hit_row in self.hit_rows[row]]
+        return self.table.spectrum_query(rows[-1], hit_rows)
+
+    def __iter__(self):
+        return iter(self.spectrum_rows)
+
+    def __len__(self):
+        return len(self.spectrum_rows)
+
+def parse_to_table(filename_pepxml, engine=None, use_mmap=False, pool=None, fields=None, msgfspecprob_mode=None, max_proteins=None):
+    """
+    Parse a .pepXML file into a PSMTable
+
+    Spectrum queries are appended to the table as they are parsed (see pepxml.iter_spectrum_queries),
+    so the per-hit dictionaries are only held for one spectrum query at a time
+
+    Pass the same pool (a pepxml.string_pool) when parsing a batch of files
+    so that the peptide and protein codes can be compared across the tables
+
+    fields limits the search scores that are read (see pepxml.parse_by_filename);
+    the spectrum and hit columns of the table are always read
+    msgfspecprob_mode is 'float' (the default), 'log10' or 'decimal' (see pepxml.parse_options)
+    Alternative proteins are read if fields is None or includes 'alternative_protein';
+    max_proteins limits the proteins kept for each hit (see pepxml.parse_options)
+    """
+    if( fields is not None ):
+        fields = list(fields) + [name for name in TABLE_FIELDS if name not in fields]
+
+    table = PSMTable(pool)
+    for spectrum_id, spectrum_query in pepxml.iter_spectrum_queries(filename_pepxml, engine, use_mmap, table.pool, fields, msgfspecprob_mode=msgfspecprob_mode,
+                                                                    max_proteins=max_proteins):
+        table.append(spectrum_id, spectrum_query)
+    return table
+
+def parse_to_tables(filename_pepxml, engine=None, use_mmap=False, pool=None, fields=None, msgfspecprob_mode=None, max_proteins=None):
+    """
+    Parse a .pepXML file into one PSMTable per msms_run_summary (see pepxml.iter_runs), in file order,
+    so that the runs of a file merged by xinteract are kept apart; table.run is the pepxml.msms_run of each table
+
+    The tables share one pool, so their peptide and protein codes can be compared;
+    the arguments are the same as for parse_to_table
+    """
+    if( fields is not None ):
+        fields = list(fields) + [name for name in TABLE_FIELDS if name not in fields]
+    if( pool is None ):
+        pool = pepxml.string_pool()
+
+    tables = []
+    for run, spectrum_queries in pepxml.iter_runs(filename_pepxml, engine, use_mmap, pool, fields, msgfspecprob_mode=msgfspecprob_mode, max_proteins=max_proteins):
+        table = PSMTable(pool, run)
+        for spectrum_id, spectrum_query in spectrum_queries:
+            table.append(spectrum_id, spectrum_query)
+        tables.append(table)
+    return tables